@@ -46,8 +46,7 @@ def read_dir(path, read_json=False):
             else:
                 lv = 0
             with open(path / file, 'r') as f:
-                chart_raw = f.read()
-            chart = read(chart_raw)
+                chart = read(f)
             charts.append((diff, lv, chart))
     for diff, lv, chart in sorted(charts):
         song.charts.append((chart, diff[1:], lv))
@@ -65,9 +64,8 @@ def write_dir(path, song : Song, save_to_parent=False):
         diffs.append(f'{diff},{lv};')
         chart_file = f'{song.name}_{diff[0]}_{lv}.xml'
         chart_files.append(f'{path.name}/{chart_file};')
-        chart_raw = chart.to_xml()
         with open(path / chart_file, 'w') as f:
-            f.write(chart_raw)
+            chart.write_xml(f)
     rena_index = f"""B.{random_uuid()}
 N?{song.name}
 S?{path.name}/{song.name}.mp3
@@ -103,16 +101,18 @@ def _chart_from_song(song, diff):
 
 
 def concat(song1 : Song, song2: Song, diff1=None, diff2=None):
-    chart1, new_diff, new_lv = _chart_from_song(song1, diff1)
-    chart2, *_ = _chart_from_song(song2, diff2)
+    return concat_all([song1, song2], [diff1, diff2])
 
-    audio1 = song1.song
-    audio2 = song2.song
+def concat_all(songs, diffs=None):
+    if diffs is None:
+        diffs = [None] * len(songs)
+    charts = [_chart_from_song(song, diff) for song, diff in zip(songs, diffs)]
+    _, new_diff, new_lv = charts[0]
 
-    new_chart = Chart.concatenate(chart1, chart2, audio1.duration)
-    new_audio = audio1.clone()
-    new_audio.concat(audio2)
+    new_audio, starts = AudioFile.concatenate([song.song for song in songs])
+    new_chart = Chart.concatenate_all([chart for chart, *_ in charts], starts[1:])
 
+    song1 = songs[0]
     new_song = Song()
     new_song.name = song1.name
     new_song.cover = song1.cover
@@ -189,9 +189,7 @@ if __name__ == '__main__':
         for path in args.source:
             songs.append(read_dir(path))
 
-        res = songs[0]
-        for song in songs[1:]:
-            res = concat(res, song)
+        res = concat_all(songs)
 
         write_dir(args.target, res, save_to_parent=args.save_to_parent)
 
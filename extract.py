@@ -8,9 +8,10 @@ import os
 import json
 from tqdm import tqdm
 
-from lib.dynamix2dynamite import convert_json
+from lib.dynamix2dynamite import write_json
 from lib.reader import read_dynamix
 from lib.chart import Board
+from lib.rendercache import RenderCache
 
 def wav_file_clip(path, start, end, fadein=None, fadeout=None, sr=None):
     audio, sample_rate = librosa.load(path, sr=sr)
@@ -211,11 +212,10 @@ def extract(song_dict, src, dst, preserve_wav=False, generate=True):
                 map_offset = map_dict['m_timeOffset']
         map_dict['m_timeOffset'] = map_offset
         if generate:
-            map_xml, _ = convert_json(map_dict)
             with open(f'{dst}/{map_id}.json', 'w', encoding='utf8') as f:
                 json.dump(map_dict, f, indent=2)
             with open(f'{dst}/{map_id}_{map_level}.xml', 'w', encoding='utf8') as f:
-                f.write(map_xml)
+                write_json(f, map_dict)
         res_maps.append({
             'id': map_id,
             'level': map_level,
@@ -332,12 +332,23 @@ def extract_clip(song_dict, src, dst, start_time, end_time, fade=4, level=None,
 
     with open(f'{dst}/{map_id}.json', 'w', encoding='utf8') as f:
         json.dump(map_dict, f, indent=2)
-    map_xml, _ = convert_json(map_dict)
     with open(f'{dst}/{map_id}_{map_level}.xml', 'w', encoding='utf8') as f:
-        f.write(map_xml)
+        write_json(f, map_dict)
 
     return map_dict, data
 
+def save_view(map_dict, path, cache=None):
+    chart = read_dynamix(map_dict)
+    board = Board(scale=0.2, time_limit=16, speed=0.8, bar_span=2, semi_bar_span=1/16)
+    if cache is not None:
+        key = cache.key(chart, board, 'board')
+        if cache.load(key, [path]):
+            return
+    img = board.generate(chart)
+    img.save(path)
+    if cache is not None:
+        cache.store(key, [path])
+
 _Str_level_name = ['CASUAL', 'NORMAL', 'HARD', 'MEGA', 'GIGA']
 
 def rena_index_from_dic(dic, ranked=True, hidden=False, charter=None, desc=None):
@@ -393,9 +404,12 @@ if __name__ == '__main__':
     parser.add_argument('--level', '-l', metavar='lv', type=int, default=None, help='The chart level to be clipped. Casual is 0 and Giga is 4. The highest level will be automatically chosen if not provided.')
     parser.add_argument('--preserve-wave', '-p', action='store_true', help='To preserve .wav files.')
     parser.add_argument('--skip', '-s', action='store_true', help='To skip extracted songs when extracting all songs.')
+    parser.add_argument('--no-cache', action='store_true', help='To render preview images without the render cache.')
 
     args = parser.parse_args()
 
+    cache = None if args.no_cache else RenderCache()
+
     preserve_wav = args.preserve_wave
 
     src = args.source[0]
@@ -458,11 +472,7 @@ if __name__ == '__main__':
                 if args.view:
                     for _res_map in res['maps']:
                         _map = _res_map['map']
-                        chart = read_dynamix(_map)
-
-                        board = Board(scale=0.2, time_limit=16, speed=0.8, bar_span=2, semi_bar_span=1/16)
-                        img = board.generate(chart)
-                        img.save(os.path.join(target, id_name, _map['m_mapID'] + '.png'))
+                        save_view(_map, os.path.join(target, id_name, _map['m_mapID'] + '.png'), cache)
             with open(os.path.join(target, '__rena_index_2'), 'w', encoding='utf8') as f:
                 f.write(''.join(rena_index))
         else:
@@ -485,20 +495,12 @@ if __name__ == '__main__':
                     if args.view:
                         for _res_map in res['maps']:
                             _map = _res_map['map']
-                            chart = read_dynamix(_map)
-
-                            board = Board(scale=0.2, time_limit=16, speed=0.8, bar_span=2, semi_bar_span=1/16)
-                            img = board.generate(chart)
-                            img.save(os.path.join(target, _map['m_mapID'] + '.png'))
+                            save_view(_map, os.path.join(target, _map['m_mapID'] + '.png'), cache)
                 else:
                     clip_start, clip_end = args.clip
                     _map, res = extract_clip(s, src, target, clip_start, clip_end, fade=args.fade, align=args.align, level=args.level, preserve_wav=preserve_wav)
                     if args.view:
-                        chart = read_dynamix(_map)
-
-                        board = Board(scale=0.2, time_limit=16, speed=0.8, bar_span=2, semi_bar_span=1/16)
-                        img = board.generate(chart)
-                        img.save(os.path.join(target, _map['m_mapID'] + '.png'))
+                        save_view(_map, os.path.join(target, _map['m_mapID'] + '.png'), cache)
                 s['file_song'] = res['song']['file']
                 s['file_cover'] = res['cover']['name']
                 s['file_preview'] = res['preview']['file']
@@ -1,7 +1,39 @@
 from PIL import Image, ImageColor, ImageDraw, ImageFont
-from math import ceil
+from math import ceil, floor
+import copy
+import hashlib
+import io
+import struct
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import numpy as np
-from .dynamix2dynamite import convert_json
+from .dynamix2dynamite import write_chart
+
+_Note_struct = struct.Struct('<bbdddd')
+
+# One record per note, laid out exactly like Note.to_bytes().
+NOTE_DTYPE = np.dtype([('type', 'i1'), ('side', 'i1'), ('pos', '<f8'), ('width', '<f8'), ('start', '<f8'), ('end', '<f8')])
+
+def _note_field(name, column):
+    # Views read their record straight from the array's buffer; going through
+    # NumPy scalars costs several times more per access.
+    dtype, offset = NOTE_DTYPE.fields[name][:2]
+    field = struct.Struct('<' + dtype.char)
+    itemsize = NOTE_DTYPE.itemsize
+    def get(self):
+        if self._notes is None:
+            return self._values[column]
+        return field.unpack_from(self._notes._buffer, self._index * itemsize + offset)[0]
+    def set(self, value):
+        if self._notes is None:
+            self._values[column] = value
+        else:
+            notes = self._notes
+            notes._own()
+            field.pack_into(notes._buffer, self._index * itemsize + offset, value)
+            notes.version += 1
+    return property(get, set)
 
 class Note:
     SIDE_LEFT = -1
@@ -22,38 +54,60 @@ class Note:
     WIDTH_HOLD = 32
     WIDTH_MIN = 14
 
+    # A note either holds its own values or is a view of one record of a NoteArray.
+    __slots__ = ('_notes', '_index', '_values')
+
+    type = _note_field('type', 0)
+    side = _note_field('side', 1)
+    pos = _note_field('pos', 2)
+    width = _note_field('width', 3)
+    start = _note_field('start', 4)
+    end = _note_field('end', 5)
+
+    def sort_key(self):
+        # Notes are ordered by start, type, end (holds only), pos and width.
+        type, _, pos, width, start, end = self.to_record()
+        return start, type, end if type == self.NOTE_HOLD else 0.0, pos, width
+
     def __lt__(self, other):
-        res = self.start - other.start
-        if res != 0: return res < 0
-        res = self.type - other.type
-        if res != 0: return res < 0
-        if self.type == self.NOTE_HOLD:
-            res = self.end - other.end
-            if res != 0: return res < 0
-        res = self.pos - other.pos
-        if res != 0: return res < 0
-        res = self.width - other.width
-        if res != 0: return res < 0
-        return False
+        # Most comparisons are decided by the start alone. Prefer
+        # sorted(notes, key=Note.sort_key) or Chart.sort() for many notes.
+        start, other_start = self.start, other.start
+        if start != other_start:
+            return start < other_start
+        return self.sort_key() < other.sort_key()
 
     def __init__(self, pos, width=1.0, side=SIDE_FRONT, type=NOTE_NORMAL, start=0.0, end=None):
-        self.type = type
-        self.side = side
-        self.width = width
-        self.pos = pos + width / 2
-        self.start = start
         if end is None:
-            self.end = start
+            end = start
         else:
-            self.end = max(start, end)
+            end = max(start, end)
+        self._notes = None
+        self._index = None
+        self._values = [type, side, pos + width / 2, width, start, end]
+
+    @classmethod
+    def _view(cls, notes, index):
+        note = cls.__new__(cls)
+        note._notes = notes
+        note._index = index
+        note._values = None
+        return note
+
+    def to_record(self):
+        if self._notes is None:
+            return tuple(self._values)
+        return _Note_struct.unpack_from(self._notes._buffer, self._index * NOTE_DTYPE.itemsize)
+
+    def to_bytes(self):
+        return _Note_struct.pack(*self.to_record())
 
     def clone(self):
-        note = Note(0, 0, self.side, self.type, self.start, self.end)
-        note.pos = self.pos
-        note.width = self.width
+        note = Note(0, 0)
+        note._values = list(self.to_record())
         return note
 
-    def generate_image(self, width_per_unit, bar_height, scale=1.0):
+    def image_params(self, width_per_unit, bar_height, scale=1.0):
         fill_color = self.COLOR_NORMAL
         outline_color = None
         width = width_per_unit * self.width
@@ -77,27 +131,350 @@ class Note:
         WIDTH_MIN = max(1, round(scale * self.WIDTH_MIN))
         width = max(width, WIDTH_MIN)
         height = max(height, WIDTH_MIN)
+        return width, height, radius, fill_color, outline_color, line_width
+
+    @staticmethod
+    def draw_image(width, height, radius, fill_color, outline_color=None, line_width=1):
         img = Image.new('RGBA', (width, height), color=(0, 0, 0, 0))
         draw = ImageDraw.Draw(img)
         draw.rounded_rectangle([(0, 0), (width, height)], radius, fill_color, outline_color, line_width)
         return img
 
+    def generate_image(self, width_per_unit, bar_height, scale=1.0):
+        return self.draw_image(*self.image_params(width_per_unit, bar_height, scale))
+
+    @staticmethod
+    def draw_segment(width, height, radius, fill_color, outline_color=None, line_width=1, top=0, bottom=None):
+        # Rows [top, bottom) of draw_image(width, height, ...), without drawing the rest of it.
+        if bottom is None:
+            bottom = height
+        img = Image.new('RGBA', (width, bottom - top), color=(0, 0, 0, 0))
+        draw = ImageDraw.Draw(img)
+        draw.rounded_rectangle([(0, -top), (width, height - top)], radius, fill_color, outline_color, line_width)
+        return img
+
+class SpriteCache:
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._sprites = OrderedDict()
+        self._arrays = {}
+        self._holds = {}
+
+    def __len__(self):
+        return len(self._sprites)
+
+    def clear(self):
+        self._sprites.clear()
+        self._arrays.clear()
+        self._holds.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, note: Note, width_per_unit, bar_height, scale):
+        params = note.image_params(width_per_unit, bar_height, scale)
+        width, height = params[0], params[1]
+        key = (note.type, width, height, scale)
+        img = self._sprites.get(key, None)
+        if img is not None:
+            self.hits += 1
+            self._sprites.move_to_end(key)
+            return key, img
+        self.misses += 1
+        img = note.draw_image(*params)
+        if self.maxsize is None or self.maxsize > 0:
+            self._sprites[key] = img
+            if self.maxsize is not None and len(self._sprites) > self.maxsize:
+                old_key, _ = self._sprites.popitem(last=False)
+                self._arrays.pop(old_key, None)
+        return key, img
+
+    def get(self, note: Note, width_per_unit, bar_height, scale=1.0):
+        return self._lookup(note, width_per_unit, bar_height, scale)[1]
+
+    def get_array(self, note: Note, width_per_unit, bar_height, scale=1.0):
+        key, img = self._lookup(note, width_per_unit, bar_height, scale)
+        res = self._arrays.get(key, None)
+        if res is None:
+            res = sprite_to_array(img)
+            if key in self._sprites:
+                self._arrays[key] = res
+        return res
+
+    def get_hold_template(self, width, radius, fill_color, outline_color, line_width):
+        # Holds of one width only differ in the length of their middle, whose rows
+        # are all alike: any hold at least as tall as the template is its first
+        # and last edge rows with the middle row repeated in between.
+        key = (width, radius, fill_color, outline_color, line_width)
+        res = self._holds.get(key, None)
+        if res is None:
+            edge = radius + line_width + 1
+            img = Note.draw_image(width, 2 * edge + 1, radius, fill_color, outline_color, line_width)
+            res = self._holds[key] = (edge, *sprite_to_array(img))
+        return res
+
+def sprite_to_array(img: Image.Image):
+    arr = np.asarray(img)
+    alpha = arr[..., 3]
+    binary = bool(np.all((alpha == 0) | (alpha == 255)))
+    return arr, binary
+
+class NoteArray:
+    # Columnar storage of notes, one NOTE_DTYPE record each. Behaves like a list of
+    # Note: indexing and iterating give views that read and write the records.
+    def __init__(self, notes=None):
+        self._set_data(np.empty(0, dtype=NOTE_DTYPE))
+        self._size = 0
+        # Set while the records are shared with a clone; the first write then
+        # copies them. Use edit() to write to data directly.
+        self._shared = False
+        # Bumped on every change, so derived data such as Chart.index can tell
+        # it is stale.
+        self.version = 0
+        if notes is not None:
+            self.extend(notes)
+
+    @classmethod
+    def from_array(cls, data):
+        res = cls()
+        res._set_data(np.ascontiguousarray(data, dtype=NOTE_DTYPE))
+        res._size = len(res._data)
+        return res
+
+    @classmethod
+    def from_readonly(cls, data):
+        # Wraps records that must not be written, such as a memory map; they
+        # are copied on the first change like after clone().
+        res = cls.from_array(data)
+        res._shared = True
+        return res
+
+    def _set_data(self, data):
+        self._data = data
+        self._buffer = memoryview(data.view(np.uint8))
+
+    # Memoryviews cannot be pickled, so only the records are sent to workers.
+    def __getstate__(self):
+        return self.data, self.version
+
+    def __setstate__(self, state):
+        data, self.version = state
+        self._set_data(np.ascontiguousarray(data, dtype=NOTE_DTYPE))
+        self._size = len(self._data)
+        self._shared = False
+
+    @property
+    def data(self):
+        # Read-only, as the records may be shared with clones; write through edit().
+        view = self._data[:self._size]
+        view.flags.writeable = False
+        return view
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for index in range(self._size):
+            yield Note._view(self, index)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            index = int(key)
+            if index < 0:
+                index += self._size
+            if not 0 <= index < self._size:
+                raise IndexError('note index out of range')
+            return Note._view(self, index)
+        res = self.from_array(self.data[key])
+        if np.may_share_memory(res._data, self._data):
+            # Slices are views; keep them apart from the original like list slices.
+            self._shared = res._shared = True
+        return res
+
+    def __setitem__(self, key, note: Note):
+        self.edit()[key] = note.to_record()
+
+    def edit(self):
+        # The records for writing in place, no longer shared with any clone.
+        self._own()
+        self.version += 1
+        return self._data[:self._size]
+
+    def _own(self):
+        if self._shared or not self._data.flags.writeable:
+            self._set_data(self.data.copy())
+            self._shared = False
+
+    def _reserve(self, size):
+        if size > len(self._data) or self._shared or not self._data.flags.writeable:
+            data = np.empty(max(size, 2 * len(self._data), 16), dtype=NOTE_DTYPE)
+            data[:self._size] = self.data
+            self._set_data(data)
+            self._shared = False
+
+    def append(self, note: Note):
+        self._reserve(self._size + 1)
+        self._data[self._size] = note.to_record()
+        self._size += 1
+        self.version += 1
+
+    def extend(self, notes):
+        if isinstance(notes, NoteArray):
+            data = notes.data
+        else:
+            data = np.array([note.to_record() for note in notes], dtype=NOTE_DTYPE)
+        self._reserve(self._size + len(data))
+        self._data[self._size : self._size + len(data)] = data
+        self._size += len(data)
+        self.version += 1
+
+    def clone(self):
+        # Copy on write: both arrays keep the same records until one changes.
+        res = self.from_array(self.data)
+        res.version = self.version
+        self._shared = res._shared = True
+        return res
+
+    def sort_keys(self):
+        # Columns of Note.sort_key, least significant first as np.lexsort wants them.
+        data = self.data
+        end = np.where(data['type'] == Note.NOTE_HOLD, data['end'], 0.0)
+        return data['width'], data['pos'], end, data['type'], data['start']
+
+    def argsort(self):
+        # Stable, so notes comparing equal keep their order like with sorted().
+        return np.lexsort(self.sort_keys())
+
+    def is_sorted(self):
+        if self._size < 2:
+            return True
+        keys = self.sort_keys()
+        # A pair is out of order when the most significant column that differs
+        # puts the second note first.
+        before = np.zeros(self._size - 1, dtype=bool)
+        for column in keys:
+            before = (column[1:] < column[:-1]) | ((column[1:] == column[:-1]) & before)
+        return not before.any()
+
+class NoteIndex:
+    # Time index of a NoteArray: note starts in sorted order, plus a centered
+    # interval tree over the holds for the notes that start before a query
+    # window but still reach into it.
+    def __init__(self, notes: NoteArray):
+        data = notes.data
+        self.version = notes.version
+        self._starts = data['start'].copy()
+        self._order = np.argsort(self._starts, kind='stable')
+        self._sorted_starts = self._starts[self._order]
+        ends = data['end']
+        spans = np.flatnonzero((data['type'] == Note.NOTE_HOLD) & (ends > self._starts))
+        self._root = self._build(self._starts, ends, spans)
+
+    @classmethod
+    def _build(cls, starts, ends, ids):
+        if len(ids) == 0:
+            return None
+        s, e = starts[ids], ends[ids]
+        center = np.median(np.concatenate([s, e]))
+        here = (s <= center) & (center <= e)
+        ids_here = ids[here]
+        by_start = ids_here[np.argsort(starts[ids_here], kind='stable')]
+        by_end = ids_here[np.argsort(ends[ids_here], kind='stable')]
+        left = cls._build(starts, ends, ids[e < center])
+        right = cls._build(starts, ends, ids[s > center])
+        return (center, left, right, by_start, starts[by_start], by_end, ends[by_end])
+
+    def stab(self, t):
+        # Holds with start <= t <= end.
+        res = []
+        node = self._root
+        while node is not None:
+            center, left, right, by_start, starts, by_end, ends = node
+            if t < center:
+                res.append(by_start[:np.searchsorted(starts, t, 'right')])
+                node = left
+            elif t > center:
+                res.append(by_end[np.searchsorted(ends, t, 'left'):])
+                node = right
+            else:
+                res.append(by_start)
+                break
+        if not res:
+            return np.empty(0, dtype=np.intp)
+        return np.concatenate(res)
+
+    def overlapping(self, t0, t1):
+        # Indices, in chart order, of the notes with start <= t1 and end >= t0.
+        lo = np.searchsorted(self._sorted_starts, t0, 'left')
+        hi = np.searchsorted(self._sorted_starts, t1, 'right')
+        spans = self.stab(t0)
+        spans = spans[self._starts[spans] < t0]
+        return np.sort(np.concatenate([self._order[lo:hi], spans]))
+
 class Chart:
     @classmethod
     def concatenate(cls, former_chart, latter_chart, song_length_sec):
-        return former_chart.clone().concat(latter_chart, song_length_sec)
+        return cls.concatenate_all([former_chart, latter_chart], [song_length_sec])
+
+    @classmethod
+    def concatenate_all(cls, charts, start_secs):
+        # Same result as folding concatenate() over the charts, where start_secs
+        # gives, for every chart after the first, the time its song starts. The
+        # notes are written once into a buffer of the final size.
+        first = charts[0]
+        bpm = first.bar_per_min
+        data = np.empty(sum(len(chart.notes) for chart in charts), dtype=NOTE_DTYPE)
+        size = len(first.notes)
+        data[:size] = first.notes.data
+        time = first.time
+        left_slide, right_slide = first.left_slide, first.right_slide
+        for chart, start_sec in zip(charts[1:], start_secs):
+            bar_offset = bpm * (start_sec + first.time_offset - chart.time_offset) / 60
+            notes = chart.notes.data
+            part = data[size : size + len(notes)]
+            part[...] = notes
+            part['start'] = bpm * notes['start'] / chart.bar_per_min
+            part['end'] = bpm * notes['end'] / chart.bar_per_min
+            part['start'] += bar_offset
+            part['end'] += bar_offset
+            if len(part):
+                time = max(time, float(part['end'].max()))
+            size += len(notes)
+            left_slide = left_slide and chart.left_slide
+            right_slide = right_slide and chart.right_slide
+        new_chart = first._with_notes(NoteArray.from_array(data))
+        new_chart.time = time
+        new_chart.left_slide = left_slide
+        new_chart.right_slide = right_slide
+        return new_chart
 
     def __init__(self):
         self.name = None
         self.map_id = None
-        self.notes = []
+        self.notes = NoteArray()
         self.time = 0.0
         self.left_slide = False
         self.right_slide = False
         self.bar_per_min = 0.0
         self.time_offset = 0.0
 
-    def clone(self):
+    @property
+    def notes(self):
+        return self._notes
+
+    @notes.setter
+    def notes(self, notes):
+        self._notes = notes if isinstance(notes, NoteArray) else NoteArray(notes)
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None or self._index.version != self._notes.version:
+            self._index = NoteIndex(self._notes)
+        return self._index
+
+    def _with_notes(self, notes):
         new_chart = Chart()
         new_chart.name = self.name
         new_chart.map_id = self.map_id
@@ -106,59 +483,72 @@ class Chart:
         new_chart.right_slide = self.right_slide
         new_chart.time_offset = self.time_offset
         new_chart.bar_per_min = self.bar_per_min
-        for note in self.notes:
-            new_chart.notes.append(note.clone())
+        new_chart.notes = notes
         return new_chart
 
+    def clone(self):
+        # The notes are shared until either chart changes them, and so is the
+        # index, which stays valid as long as the versions match.
+        new_chart = self._with_notes(self.notes.clone())
+        new_chart._index = self._index
+        return new_chart
+
+    def sort(self):
+        # Views of the notes taken before sorting keep pointing at their old slots.
+        if not self.notes.is_sorted():
+            data = self.notes.edit()
+            data[:] = data[self.notes.argsort()]
+        return self
+
     def move(self, bar_offset):
-        for note in self.notes:
-            note.start = note.start + bar_offset
-            note.end = note.end + bar_offset
+        data = self.notes.edit()
+        data['start'] += bar_offset
+        data['end'] += bar_offset
         self.time = self.time + bar_offset
         return self
 
     def clip(self, start, end):
-        res = self.clone()
+        res = self._with_notes(NoteArray())
         res.time = end - start
-        new_notes = []
-        for note in res.notes:
-            if note.type == Note.NOTE_HOLD:
-                if start <= note.start:
-                    if end >= note.end:
-                        new_notes.append(note)
-                    elif end == note.start:
-                        note.type = Note.NOTE_NORMAL
-                        note.end = end
-                        new_notes.append(note)
-                    elif end > note.start:
-                        note.end = end
-                        new_notes.append(note)
-                else:
-                    if start == note.end:
-                        note.type = Note.NOTE_CHAIN
-                        note.start = start
-                        new_notes.append(note)
-                    elif start < note.end:
-                        note.start = start
-                        note.end = min(end, note.end)
-                        new_notes.append(note)
-            else:
-                if start <= note.start and note.start <= end:
-                    new_notes.append(note)
-        for note in new_notes:
-            note.start -= start
-            note.end -= start
-        res.notes = new_notes
+        # Only notes overlapping the window can be kept; fancy indexing copies them.
+        data = self.notes.data[self.index.overlapping(start, end)]
+        types, starts, ends = data['type'], data['start'], data['end']
+        holds = types == Note.NOTE_HOLD
+
+        # Holds starting inside the window are cut at its end; a hold starting right
+        # at the end becomes a tap. Holds starting before the window are cut at its
+        # start; a hold ending right at the start becomes a chain.
+        inside = holds & (start <= starts)
+        before = holds & (start > starts)
+        to_normal = inside & (end < ends) & (end == starts)
+        cut_end = inside & (end < ends) & (end > starts)
+        to_chain = before & (start == ends)
+        cut_start = before & (start < ends)
+        keep = (inside & (end >= ends)) | to_normal | cut_end | to_chain | cut_start
+        keep |= ~holds & (start <= starts) & (starts <= end)
+
+        types[to_normal] = Note.NOTE_NORMAL
+        ends[to_normal | cut_end] = end
+        types[to_chain] = Note.NOTE_CHAIN
+        starts[to_chain] = start
+        ends[cut_start] = np.minimum(end, ends[cut_start])
+        starts[cut_start] = start
+
+        data = data[keep]
+        data['start'] -= start
+        data['end'] -= start
+        res.notes = NoteArray.from_array(data)
         return res
 
     def concat(self, other, song_length_sec):
         other = other.change_bpm(self.bar_per_min)
         time_offset = song_length_sec + self.time_offset - other.time_offset
         bar_offset = self.bar_per_min * time_offset / 60
-        for note in other.notes:
-            note.start += bar_offset
-            note.end += bar_offset
-            self.time = max(self.time, note.end)
+        data = other.notes.edit()
+        data['start'] += bar_offset
+        data['end'] += bar_offset
+        if len(data):
+            self.time = max(self.time, float(data['end'].max()))
         self.notes.extend(other.notes)
         self.left_slide = self.left_slide and other.left_slide
         self.right_slide = self.right_slide and other.right_slide
@@ -167,9 +557,9 @@ class Chart:
     def change_bpm(self, new_bpm):
         new_chart = self.clone()
         new_chart.bar_per_min = new_bpm
-        for note in new_chart.notes:
-            note.start = new_bpm * note.start / self.bar_per_min
-            note.end = new_bpm * note.end / self.bar_per_min
+        data = new_chart.notes.edit()
+        data['start'] = new_bpm * data['start'] / self.bar_per_min
+        data['end'] = new_bpm * data['end'] / self.bar_per_min
         return new_chart
 
     def change_speed(self, speed=1.0):
@@ -199,56 +589,47 @@ class Chart:
                 'm_notes': m_notesRight,
             },
         }
+        # Built from the note columns, as write_chart does; going through a view
+        # per note costs several times more.
+        notes = self.notes.data
+        types = notes['type'].astype(int)
+        types[(types != Note.NOTE_CHAIN) & (types != Note.NOTE_HOLD)] = Note.NOTE_NORMAL
+        positions = notes['pos'] - notes['width'] / 2
+        side_notes = {Note.SIDE_LEFT: m_notesLeft, Note.SIDE_RIGHT: m_notesRight}
         note_id = 0
-        for note in self.notes:
-            if note.type == Note.NOTE_CHAIN:
-                typ = 1
-            elif note.type == Note.NOTE_HOLD:
-                typ = 2
-            elif note.type == Note.NOTE_NORMAL:
-                typ = 0
-            else:
-                typ = 0
-            pos = note.pos - note.width / 2
-            note_dict = {
+        for typ, side, pos, width, start, end in zip(
+            types.tolist(), notes['side'].tolist(), positions.tolist(),
+            notes['width'].tolist(), notes['start'].tolist(), notes['end'].tolist(),
+        ):
+            target = side_notes.get(side, m_notes)
+            target.append({
                 'm_id': note_id,
                 'm_type': typ,
-                'm_time': note.start,
+                'm_time': start,
                 'm_position': pos,
-                'm_width': note.width,
+                'm_width': width,
                 'm_subId': note_id + 1 if typ == 2 else -1,
-            }
+            })
             note_id += 1
-            if note.side == Note.SIDE_FRONT:
-                m_notes.append(note_dict)
-            elif note.side == Note.SIDE_LEFT:
-                m_notesLeft.append(note_dict)
-            elif note.side == Note.SIDE_RIGHT:
-                m_notesRight.append(note_dict)
-            else:
-                m_notes.append(note_dict)
             if typ == 2:
-                note_dict = {
+                target.append({
                     'm_id': note_id,
                     'm_type': 3,
-                    'm_time': note.end,
+                    'm_time': end,
                     'm_position': pos,
-                    'm_width': note.width,
+                    'm_width': width,
                     'm_subId': -1,
-                }
+                })
                 note_id += 1
-                if note.side == Note.SIDE_FRONT:
-                    m_notes.append(note_dict)
-                elif note.side == Note.SIDE_LEFT:
-                    m_notesLeft.append(note_dict)
-                elif note.side == Note.SIDE_RIGHT:
-                    m_notesRight.append(note_dict)
-                else:
-                    m_notes.append(note_dict)
         return data
 
+    def write_xml(self, fp):
+        write_chart(fp, self)
+
     def to_xml(self):
-        return convert_json(self.to_dict())[0]
+        fp = io.StringIO()
+        self.write_xml(fp)
+        return fp.getvalue()
 
 
 import pydub
@@ -346,6 +727,26 @@ class AudioFile:
         self.sample_width = max(self.sample_width, audio.sample_width)
         return self
 
+    @classmethod
+    def concatenate(cls, audios):
+        # Same samples as chaining concat(), copied once into a buffer of the
+        # final size. Also returns the time in seconds each input starts at.
+        first = audios[0]
+        audios = [audio if audio.sample_rate == first.sample_rate else audio.clone().set_sample_rate(first.sample_rate) for audio in audios]
+        channels = max(audio.data.shape[-1] for audio in audios)
+        res = cls()
+        res.sample_rate = first.sample_rate
+        res.sample_width = max(audio.sample_width for audio in audios)
+        res.data = np.empty((sum(audio.data.shape[0] for audio in audios), channels), dtype=np.result_type(*(audio.data for audio in audios)))
+        starts = []
+        size = 0
+        for audio in audios:
+            starts.append(size / res.sample_rate)
+            # Mono inputs are broadcast to every channel.
+            res.data[size : size + audio.data.shape[0]] = audio.data
+            size += audio.data.shape[0]
+        return res, starts
+
     def linear_transform(self, start : float, end : float, start_amp : float, end_amp : float):
         if not self.valid:
             return self
@@ -396,6 +797,82 @@ class Song:
         self.cover : Image.Image = None
 
 
+@lru_cache(maxsize=None)
+def _load_font(size):
+    return ImageFont.truetype('Fonts/arial.ttf', size=size)
+
+@lru_cache(maxsize=None)
+def _glyph_advance(pair, font_size):
+    # Advance of the first character, kerned against the second, in 1/64 px.
+    font = _load_font(font_size)
+    return round((font.getlength(pair) - font.getlength(pair[1:])) * 64)
+
+@lru_cache(maxsize=16384)
+def _render_glyph(char, font_size, sx, sy):
+    # A glyph drawn at a subpixel offset of (sx, sy) / 64 px, the resolution
+    # FreeType positions glyphs at.
+    font = _load_font(font_size)
+    left, top, right, bottom = font.getbbox(char, anchor='lm')
+    ox, oy = 2 - floor(left), 2 - floor(top)
+    mask = Image.new('L', (ceil(right) + ox + 2, ceil(bottom) + oy + 2), 0)
+    ImageDraw.Draw(mask).text((ox + sx / 64, oy + sy / 64), char, fill=255, font=font, anchor='lm')
+    return np.asarray(mask), (ox, oy)
+
+def _render_label(text, font_size, fx, fy):
+    # Labels are unique per bar, so they are put together from cached glyphs,
+    # placed and blended the way FreeType draws a whole string.
+    advances = [_glyph_advance(text[i : i + 2], font_size) for i in range(len(text))]
+    # The right anchor is snapped to whole pixels, kerning is not.
+    pen = round(fx * 64) - ((sum(advances) + 32) & ~63)
+    rise = round(fy * 64)
+    glyphs = []
+    for char, advance in zip(text, advances):
+        mask, (ox, oy) = _render_glyph(char, font_size, pen & 63, rise & 63)
+        glyphs.append((mask, (pen >> 6) - ox, (rise >> 6) - oy))
+        pen += advance
+    left = min(x for _, x, _ in glyphs)
+    top = min(y for _, _, y in glyphs)
+    right = max(x + mask.shape[1] for mask, x, _ in glyphs)
+    bottom = max(y + mask.shape[0] for mask, _, y in glyphs)
+    label = np.zeros((bottom - top, right - left), dtype=np.uint16)
+    for mask, x, y in glyphs:
+        dst = label[y - top : y - top + mask.shape[0], x - left : x - left + mask.shape[1]]
+        dst[...] = mask + (dst * (255 - mask) + 127) // 255
+    return label.astype(np.uint8), (-left, -top)
+
+
+PageGeometry = namedtuple('PageGeometry', (
+    'page_width', 'page_height', 'bar_height', 'bottom_line_y',
+    'side_line_leftside_x', 'side_line_left_x', 'side_line_right_x', 'side_line_rightside_x',
+))
+
+class NoteLayout:
+    LAYER_HOLD = 0
+    LAYER_NOTE = 1
+
+    # Screen geometry of a list of notes, one array entry per note. x and y are the
+    # top left corner of the note image on the whole board; holds that run over
+    # several pages are drawn on each of them by Board.hold_segments, starting from
+    # page and ending on end_page. center is the note's x on its own page and unit
+    # the width of one lane unit, both before rounding.
+    def __init__(self, x, y, width, height, page, end_page, layer, center, unit):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.page = page
+        self.end_page = end_page
+        self.layer = layer
+        self.center = center
+        self.unit = unit
+
+    def __len__(self):
+        return len(self.x)
+
+    def order(self):
+        # Holds are drawn first so taps and chains stay on top of them.
+        return np.argsort(self.layer, kind='stable')
+
 class Board:
     SIDE_BORDER = -0.3#-0.2
     SIDE_CAP = 6.1
@@ -436,58 +913,306 @@ class Board:
     FONT_SIZE = 96
     FONT_COLOR = (255, 255, 255, 255)
 
-    def __init__(self, scale=0.5, time_limit: int=32, speed = 0.5, bar_span = 2, semi_bar_span = 1 / 16):
+    BACKENDS = ('pil', 'numpy')
+
+    # Levels below LOD_THUMBNAIL_SCALE are downsampled from a drawn level at
+    # least 1 / LOD_DOWNSAMPLE_LIMIT times larger.
+    LOD_THUMBNAIL_SCALE = 0.1
+    LOD_DOWNSAMPLE_LIMIT = 0.5
+
+    # Bump when a change alters the rendered output, so cached renders are invalidated.
+    RENDER_VERSION = 1
+
+    def __init__(self, scale=0.5, time_limit: int=32, speed = 0.5, bar_span = 2, semi_bar_span = 1 / 16, sprite_cache_size=256, backend='pil'):
+        if backend not in self.BACKENDS:
+            raise ValueError(f'Unknown board backend "{backend}".')
         self.scale = scale
         self.notes = []
         self.time_limit = round(time_limit)
         self.speed = speed
         self.bar_span = bar_span
         self.semi_bar_span = semi_bar_span
+        self.sprite_cache = SpriteCache(sprite_cache_size)
+        self._page_templates = {}
+        self._page_arrays = {}
+        self._rendered_pages = {}
+        self.dirty_pages = []
+        self.backend = backend
+
+    def render_params(self):
+        return (self.RENDER_VERSION, self.scale, self.time_limit, self.speed, self.bar_span, self.semi_bar_span)
+
+    def __getstate__(self):
+        # Caches are rebuilt on demand; don't ship them to worker processes.
+        state = self.__dict__.copy()
+        state['sprite_cache'] = SpriteCache(self.sprite_cache.maxsize)
+        state['_page_templates'] = {}
+        state['_page_arrays'] = {}
+        state['_rendered_pages'] = {}
+        return state
+
+    def generate(self, chart: Chart, workers=None, scales=None):
+        if scales is not None:
+            return self.generate_levels(chart, scales, workers)
+        pages = self.page_count(chart)
+        if workers is None or workers <= 1 or pages <= 1:
+            if self.backend == 'numpy':
+                canvas, geometry = self.draw_board_array(chart)
+                self.draw_notes_numpy(canvas, geometry, chart)
+                return _array_image(canvas)
+            board, geometry = self.draw_board(chart)
+            self.draw_notes(board, geometry, chart)
+            return board
+        board = None
+        for index, page in enumerate(self.generate_pages(chart, workers)):
+            if board is None:
+                board = Image.new('RGBA', (page.width * pages, page.height))
+            board.paste(page, (index * page.width, 0))
+        return board
+
+    def rescaled(self, scale):
+        # Copying goes through __getstate__, so the new board starts with empty caches.
+        board = copy.copy(self)
+        board.scale = scale
+        return board
 
-    def generate(self, chart: Chart):
-        board, args = self.draw_board(chart)
-        self.draw_notes(board, args, chart)
+    def generate_levels(self, chart: Chart, scales, workers=None):
+        # Drawing is mostly flat fills, so rendering a level directly is cheaper
+        # than resampling a larger one. Only thumbnails, where minimum line and
+        # note sizes would dominate, are downsampled from the nearest level drawn.
+        pages = self.page_count(chart)
+        levels = {}
+        for scale in sorted(set(scales), reverse=True):
+            board = self if scale == self.scale else self.rescaled(scale)
+            source = min(levels, default=None)
+            if scale < self.LOD_THUMBNAIL_SCALE and source is not None and scale / source <= self.LOD_DOWNSAMPLE_LIMIT:
+                levels[scale] = board.downsample(levels[source], pages)
+            else:
+                levels[scale] = board.generate(chart, workers)
+        return [levels[scale] for scale in scales]
+
+    def downsample(self, img: Image.Image, pages):
+        # Resizes a board rendered at another scale to this board's page geometry,
+        # page by page so that pages stay aligned.
+        page_img, _ = self.draw_page()
+        pagew, pageh = page_img.size
+        src_pagew = img.width // pages
+        res = Image.new('RGBA', (pagew * pages, pageh))
+        for i in range(pages):
+            page = img.crop((i * src_pagew, 0, (i + 1) * src_pagew, img.height))
+            res.paste(page.resize((pagew, pageh), Image.BOX), (i * pagew, 0))
+        return res
+
+    def page_count(self, chart: Chart):
+        return ceil(chart.time / self.time_limit)
+
+    def page_range(self, note: Note):
+        page_number = int(note.start / self.time_limit)
+        end_page_number = page_number
+        if note.type == Note.NOTE_HOLD:
+            end_page_number = int(note.end / self.time_limit)
+        return page_number, end_page_number
+
+    def page_notes(self, chart: Chart, index, geometry=None):
+        if geometry is None:
+            geometry = self.page_geometry()
+        # A note drawn on page k starts before page k + 2 and ends after page k - 2;
+        # the time index narrows the chart down to those.
+        candidates = chart.index.overlapping((index - 2) * self.time_limit, (index + 2) * self.time_limit)
+        layout = self.layout(chart, chart.notes[candidates], geometry)
+        # Sprites at the page borders spill over onto the neighbouring pages.
+        # The check is one pixel conservative, as rounding depends on the page offset.
+        x0 = layout.x - layout.page * geometry.page_width
+        first = layout.page - (x0 <= 0)
+        last = layout.end_page + (x0 + layout.width >= geometry.page_width)
+        return candidates[(first <= index) & (index <= last)]
+
+    def bucket_notes(self, chart: Chart):
+        geometry = self.page_geometry()
+        return [self.page_notes(chart, index, geometry).tolist() for index in range(self.page_count(chart))]
+
+    def generate_page(self, chart: Chart, index, buckets=None):
+        if buckets is None:
+            pages = self.page_count(chart)
+            notes = chart.notes[self.page_notes(chart, index)]
+        else:
+            pages = len(buckets)
+            notes = chart.notes[buckets[index]]
+        if self.backend == 'numpy':
+            canvas, geometry = self.draw_board_page_array(chart, index, pages)
+            self.draw_notes_numpy(canvas, geometry, chart, notes, index * geometry.page_width)
+            return _array_image(canvas)
+        page, geometry = self.draw_board_page(chart, index, pages)
+        self.draw_notes(page, geometry, chart, notes, index * page.width)
+        return page
+
+    def generate_pages(self, chart: Chart, workers=None, indices=None, buckets=None):
+        if buckets is None:
+            buckets = self.bucket_notes(chart)
+        if indices is None:
+            indices = range(len(buckets))
+        indices = list(indices)
+        if workers is None or workers <= 1 or len(indices) <= 1:
+            for index in indices:
+                yield self.generate_page(chart, index, buckets)
+            return
+        # Several page ranges per worker keep the pool balanced; only a bounded
+        # number of ranges is in flight so streamed output stays small.
+        chunk = max(1, ceil(len(indices) / (workers * 4)))
+        with ProcessPoolExecutor(workers) as pool:
+            futures = deque()
+            for start in range(0, len(indices), chunk):
+                futures.append(pool.submit(_generate_page_range, self, chart, buckets, indices[start : start + chunk]))
+                if len(futures) >= workers * 2:
+                    yield from futures.popleft().result()
+            while futures:
+                yield from futures.popleft().result()
+
+    def page_fingerprints(self, chart: Chart, buckets=None):
+        if buckets is None:
+            buckets = self.bucket_notes(chart)
+        pages = len(buckets)
+        head = struct.pack('<dd', chart.bar_per_min, chart.time_offset) + repr(self.render_params()).encode()
+        data = chart.notes.data
+        res = []
+        for index in range(pages):
+            h = hashlib.sha1(head)
+            h.update(struct.pack('<?', index < pages - 1))
+            h.update(data[buckets[index]].tobytes())
+            res.append(h.digest())
+        return res
+
+    def update_pages(self, chart: Chart, workers=None):
+        buckets = self.bucket_notes(chart)
+        pages = len(buckets)
+        fingerprints = self.page_fingerprints(chart, buckets)
+        rendered = self._rendered_pages
+        dirty = [index for index in range(pages) if index not in rendered or rendered[index][0] != fingerprints[index]]
+        for index, page in zip(dirty, self.generate_pages(chart, workers, dirty, buckets)):
+            rendered[index] = (fingerprints[index], page)
+        for index in [index for index in rendered if index >= pages]:
+            del rendered[index]
+        self.dirty_pages = dirty
+        return [rendered[index][1] for index in range(pages)]
+
+    def generate_incremental(self, chart: Chart, workers=None):
+        board = None
+        pages = self.update_pages(chart, workers)
+        for index, page in enumerate(pages):
+            if board is None:
+                board = Image.new('RGBA', (page.width * len(pages), page.height))
+            board.paste(page, (index * page.width, 0))
+        if board is None:
+            board, _ = self.draw_board(chart)
         return board
 
     def draw_board(self, chart: Chart):
         pages = ceil(chart.time / self.time_limit)
-        page_img, args = self.draw_page()
+        page_img, geometry = self.draw_page()
         pagew, pageh = page_img.size
         img = Image.new('RGBA', (pagew * pages, pageh))
         for i in range(pages):
+            page_img, _ = self.draw_page((-i * self.time_limit) % self.bar_span)
             img.paste(page_img, (i * pagew, 0))
         draw = ImageDraw.Draw(img)
 
-        font_size = round(self.FONT_SIZE * self.scale)
-        font = ImageFont.truetype('Fonts/arial.ttf', size=font_size)
-
-        page_width, page_height, bar_height, bottom_line_y, side_line_leftside_x, side_line_left_x, side_line_right_x, side_line_rightside_x = args
-        for i in range(0, pages * self.time_limit + self.bar_span, self.bar_span):
-            pg = int(i / self.time_limit)
-            x = page_width * pg
-            y = bottom_line_y - bar_height * self.scale * (i - pg * self.time_limit)
-            if i % self.time_limit != 0:
-                draw.line([(x, y), (x + page_width, y)], fill=self.BAR_LINE_COLOR, width=max(1, round(self.scale * self.BAR_LINE_WIDTH)))
-            if self.semi_bar_span and self.semi_bar_span > 0:
-                for j in np.arange(self.semi_bar_span, self.bar_span, self.semi_bar_span):
-                    semi_y = y - bar_height * self.scale * j
-                    draw.line([(x, semi_y), (x + page_width, semi_y)], fill=self.SEMI_BAR_LINE_COLOR, width=max(1, round(self.scale * self.SEMI_BAR_LINE_WIDTH)))
-            time = round((i / chart.bar_per_min * 60 - chart.time_offset) * 1000)
-            h = time // 3600000
-            m = (time % 3600000) // 60000
-            s = (time % 60000) // 1000
-            ms = time % 1000
-            if h == 0:
-                text = "%02d:%02d:%03d %d" % (m, s, ms, i)
-            else:
-                text = "%02d:%02d:%02d:%03d %d" % (h, m, s, ms, i)
-            draw.text((x + side_line_left_x - font_size / 2, y - font_size), text, fill=self.FONT_COLOR, font=font, anchor='rm')
+        for xy, text, font_size in self.board_labels(chart, pages, geometry):
+            self.draw_label(img, xy, text, font_size)
 
         for i in range(1, pages):
             draw.line([(i * pagew, 0), (i * pagew, pageh)], fill=self.SPLIT_LINE_COLOR, width=max(1, round(self.scale * self.SPLIT_LINE_WIDTH)))
-        return img, args
+        return img, geometry
+
+    def draw_board_array(self, chart: Chart):
+        # draw_board for the numpy backend, drawn straight into an array.
+        pages = ceil(chart.time / self.time_limit)
+        _, geometry = self.draw_page()
+        pagew, pageh = geometry.page_width, geometry.page_height
+        canvas = np.empty((pageh, pagew * pages, 4), dtype=np.uint8)
+        for i in range(pages):
+            canvas[:, i * pagew : (i + 1) * pagew] = self.draw_page_array((-i * self.time_limit) % self.bar_span)
+
+        for xy, text, font_size in self.board_labels(chart, pages, geometry):
+            self.draw_label_array(canvas, xy, text, font_size)
+
+        for i in range(1, pages):
+            _draw_vertical_line(canvas, i * pagew, max(1, round(self.scale * self.SPLIT_LINE_WIDTH)), self.SPLIT_LINE_COLOR)
+        return canvas, geometry
+
+    def board_labels(self, chart: Chart, pages, geometry: PageGeometry):
+        font_size = round(self.FONT_SIZE * self.scale)
+        for i in range(0, pages * self.time_limit + self.bar_span, self.bar_span):
+            pg = int(i / self.time_limit)
+            x = geometry.page_width * pg
+            y = geometry.bottom_line_y - geometry.bar_height * self.scale * (i - pg * self.time_limit)
+            yield (x + geometry.side_line_left_x - font_size / 2, y - font_size), self.bar_label(chart, i), font_size
+
+    def draw_board_page(self, chart: Chart, index, pages=None):
+        if pages is None:
+            pages = self.page_count(chart)
+        page_img, geometry = self.draw_page((-index * self.time_limit) % self.bar_span)
+        img = page_img.copy()
+        pagew, pageh = img.size
+        draw = ImageDraw.Draw(img)
 
-    def draw_page(self):
+        for xy, text, font_size in self.page_labels(chart, index, geometry):
+            self.draw_label(img, xy, text, font_size)
+
+        split_width = max(1, round(self.scale * self.SPLIT_LINE_WIDTH))
+        if index > 0:
+            draw.line([(0, 0), (0, pageh)], fill=self.SPLIT_LINE_COLOR, width=split_width)
+        if index < pages - 1:
+            draw.line([(pagew, 0), (pagew, pageh)], fill=self.SPLIT_LINE_COLOR, width=split_width)
+        return img, geometry
+
+    def draw_board_page_array(self, chart: Chart, index, pages=None):
+        # draw_board_page for the numpy backend, drawn straight into an array.
+        if pages is None:
+            pages = self.page_count(chart)
+        canvas = self.draw_page_array((-index * self.time_limit) % self.bar_span).copy()
+        _, geometry = self.draw_page()
+
+        for xy, text, font_size in self.page_labels(chart, index, geometry):
+            self.draw_label_array(canvas, xy, text, font_size)
+
+        split_width = max(1, round(self.scale * self.SPLIT_LINE_WIDTH))
+        if index > 0:
+            _draw_vertical_line(canvas, 0, split_width, self.SPLIT_LINE_COLOR)
+        if index < pages - 1:
+            _draw_vertical_line(canvas, geometry.page_width, split_width, self.SPLIT_LINE_COLOR)
+        return canvas, geometry
+
+    def page_labels(self, chart: Chart, index, geometry: PageGeometry):
+        font_size = round(self.FONT_SIZE * self.scale)
+        first_bar = -(-index * self.time_limit // self.bar_span) * self.bar_span
+        for i in range(first_bar, (index + 1) * self.time_limit, self.bar_span):
+            y = geometry.bottom_line_y - geometry.bar_height * self.scale * (i - index * self.time_limit)
+            yield (geometry.side_line_left_x - font_size / 2, y - font_size), self.bar_label(chart, i), font_size
+
+    def bar_label(self, chart: Chart, bar):
+        time = round((bar / chart.bar_per_min * 60 - chart.time_offset) * 1000)
+        h = time // 3600000
+        m = (time % 3600000) // 60000
+        s = (time % 60000) // 1000
+        ms = time % 1000
+        if h == 0:
+            return "%02d:%02d:%03d %d" % (m, s, ms, bar)
+        return "%02d:%02d:%02d:%03d %d" % (h, m, s, ms, bar)
+
+    def draw_label(self, img: Image.Image, xy, text, font_size):
+        x, y = xy
+        ix, iy = int(x), int(y)
+        mask, (ox, oy) = _render_label(text, font_size, x - ix, y - iy)
+        mask = Image.fromarray(mask)
+        img.paste(self.FONT_COLOR, (ix - ox, iy - oy, ix - ox + mask.width, iy - oy + mask.height), mask=mask)
+
+    def draw_label_array(self, board: np.ndarray, xy, text, font_size):
+        x, y = xy
+        ix, iy = int(x), int(y)
+        mask, (ox, oy) = _render_label(text, font_size, x - ix, y - iy)
+        _fill_mask(board, self.FONT_COLOR, mask, ix - ox, iy - oy)
+
+    def page_geometry(self):
         page_width = round((
             2 * (self.SIDE_VISIBLE_CAP - self.SIDE_VISIBLE_LIMIT) +
             self.FRONT_BOARD_RATE * (self.FRONT_VISIBLE_RIGHT_LIMIT - self.FRONT_VISIBLE_LEFT_LIMIT)
@@ -511,6 +1236,18 @@ class Board:
             (self.SIDE_BORDER - self.SIDE_VISIBLE_LIMIT) +
             self.FRONT_BOARD_RATE * (self.FRONT_VISIBLE_RIGHT_LIMIT - self.FRONT_VISIBLE_LEFT_LIMIT)
         ) * self.BOARD_SIZE * self.scale)
+        return PageGeometry(page_width, page_height, bar_height, bottom_line_y, side_line_leftside_x, side_line_left_x, side_line_right_x, side_line_rightside_x)
+
+    def draw_page(self, bar_offset=0):
+        key = (bar_offset, self.render_params())
+        cached = self._page_templates.get(key, None)
+        if cached is not None:
+            return cached
+
+        geometry = self.page_geometry()
+        page_width, page_height, bottom_line_y = geometry.page_width, geometry.page_height, geometry.bottom_line_y
+        page_bottom = page_height - bottom_line_y
+        bar_height = geometry.bar_height
 
         img = Image.new('RGBA', (page_width, page_height), self.BACKGROUND_COLOR)
         draw = ImageDraw.Draw(img)
@@ -520,67 +1257,270 @@ class Board:
 
         draw.line([(0, bottom_line_y), (page_width, bottom_line_y)], fill=self.LINE_COLOR, width=BOTTOM_LINE_WIDTH)
         draw.line([(0, page_bottom), (page_width, page_bottom)], fill=self.LINE_COLOR, width=BOTTOM_LINE_WIDTH)
-        draw.line([(side_line_leftside_x, page_bottom), (side_line_leftside_x, bottom_line_y)], fill=self.LINE_COLOR, width=SIDE_LINE_WIDTH)
-        draw.line([(side_line_left_x, page_bottom), (side_line_left_x, bottom_line_y)], fill=self.LINE_COLOR, width=SIDE_LINE_WIDTH)
-        draw.line([(side_line_right_x, page_bottom), (side_line_right_x, bottom_line_y)], fill=self.LINE_COLOR, width=SIDE_LINE_WIDTH)
-        draw.line([(side_line_rightside_x, page_bottom), (side_line_rightside_x, bottom_line_y)], fill=self.LINE_COLOR, width=SIDE_LINE_WIDTH)
-
-        return img, (page_width, page_height, bar_height, bottom_line_y, side_line_leftside_x, side_line_left_x, side_line_right_x, side_line_rightside_x)
-
-    def draw_notes(self, board: Image.Image, args, chart: Chart):
-        page_width, page_height, bar_height, bottom_line_y, \
-        side_line_leftside_x, side_line_left_x, side_line_right_x, side_line_rightside_x = args
-
-        bar_height = bar_height * self.scale
-
-        board_front = Image.new('RGBA', board.size, (0, 0, 0, 0))
-
-        for note in chart.notes:
-            note : Note
-            side = note.side
-            width_per_unit = self.NOTE_SIZE * self.scale
-            if side == Note.SIDE_FRONT:
-                width_per_unit *= self.FRONT_NOTE_RATE
-                
-            if side == Note.SIDE_LEFT:
-                x = (self.SIDE_VISIBLE_CAP - note.pos) * self.BOARD_SIZE * self.scale
-            elif side == Note.SIDE_FRONT:
-                x = side_line_left_x + (note.pos - self.FRONT_LEFT_BORDER) * self.BOARD_SIZE * self.FRONT_BOARD_RATE * self.scale
-            else:
-                x = side_line_rightside_x + (note.pos - self.SIDE_BORDER) * self.BOARD_SIZE * self.scale
-            page_number = int(note.start / self.time_limit)
-            end_page_number = page_number
-            if note.type == Note.NOTE_HOLD:
-                end_page_number = int(note.end / self.time_limit)
-            img = note.generate_image(round(width_per_unit), round(bar_height), scale=self.scale)
+        for x in (geometry.side_line_leftside_x, geometry.side_line_left_x, geometry.side_line_right_x, geometry.side_line_rightside_x):
+            draw.line([(x, page_bottom), (x, bottom_line_y)], fill=self.LINE_COLOR, width=SIDE_LINE_WIDTH)
 
-            WIDTH_HOLD_2 = max(1, round(self.scale * Note.WIDTH_HOLD / 2))
 
-            if page_number == end_page_number:
-                x += page_number * page_width
-                y = bottom_line_y - (note.start - page_number * self.time_limit) * bar_height
-                realx = round(x - img.width / 2)
-                if note.type == Note.NOTE_HOLD:
-                    realy = round(y - img.height + WIDTH_HOLD_2)
-                else:
-                    realy = round(y - img.height / 2)
-                if note.type == Note.NOTE_HOLD:
-                    board.paste(img, (realx, realy), mask=img)
-                else:
-                    board_front.paste(img, (realx, realy), mask=img)
+        for i in range(bar_offset, self.time_limit, self.bar_span):
+            y = bottom_line_y - bar_height * self.scale * i
+            if i != 0:
+                draw.line([(0, y), (page_width, y)], fill=self.BAR_LINE_COLOR, width=max(1, round(self.scale * self.BAR_LINE_WIDTH)))
+            if self.semi_bar_span and self.semi_bar_span > 0:
+                for j in np.arange(self.semi_bar_span, self.bar_span, self.semi_bar_span):
+                    semi_y = y - bar_height * self.scale * j
+                    draw.line([(0, semi_y), (page_width, semi_y)], fill=self.SEMI_BAR_LINE_COLOR, width=max(1, round(self.scale * self.SEMI_BAR_LINE_WIDTH)))
+
+        res = img, geometry
+        self._page_templates[key] = res
+        return res
+
+    def draw_page_array(self, bar_offset=0):
+        key = (bar_offset, self.render_params())
+        res = self._page_arrays.get(key, None)
+        if res is None:
+            res = self._page_arrays[key] = np.asarray(self.draw_page(bar_offset)[0])
+        return res
+
+    def layout(self, chart: Chart, notes=None, geometry=None):
+        if geometry is None:
+            geometry = self.page_geometry()
+        if notes is None:
+            notes = chart.notes
+
+        if not isinstance(notes, NoteArray):
+            notes = NoteArray(notes)
+        data = notes.data
+        types, sides = data['type'].astype(np.int64), data['side'].astype(np.int64)
+        pos, widths, starts, ends = data['pos'], data['width'], data['start'], data['end']
+
+        bar_height = geometry.bar_height * self.scale
+        holds = types == Note.NOTE_HOLD
+
+        unit = np.where(sides == Note.SIDE_FRONT, self.NOTE_SIZE * self.scale * self.FRONT_NOTE_RATE, self.NOTE_SIZE * self.scale)
+        center = np.where(
+            sides == Note.SIDE_LEFT,
+            (self.SIDE_VISIBLE_CAP - pos) * self.BOARD_SIZE * self.scale,
+            np.where(
+                sides == Note.SIDE_FRONT,
+                geometry.side_line_left_x + (pos - self.FRONT_LEFT_BORDER) * self.BOARD_SIZE * self.FRONT_BOARD_RATE * self.scale,
+                geometry.side_line_rightside_x + (pos - self.SIDE_BORDER) * self.BOARD_SIZE * self.scale,
+            ),
+        )
+        page = np.trunc(starts / self.time_limit).astype(np.int64)
+        end_page = np.where(holds, np.trunc(ends / self.time_limit).astype(np.int64), page)
+
+        # Same sizes as Note.image_params.
+        WIDTH_MIN = max(1, round(self.scale * Note.WIDTH_MIN))
+        WIDTH_HOLD = max(1, round(self.scale * Note.WIDTH_HOLD))
+        WIDTH_HOLD_2 = max(1, round(self.scale * Note.WIDTH_HOLD / 2))
+        width = np.maximum(np.round(np.round(unit) * widths), WIDTH_MIN).astype(np.int64)
+        height = np.select(
+            [types == Note.NOTE_CHAIN, holds],
+            [max(1, round(self.scale * Note.WIDTH_CHAIN)), np.round(round(bar_height) * (ends - starts) + WIDTH_HOLD)],
+            max(1, round(self.scale * Note.WIDTH_NORMAL)),
+        )
+        height = np.maximum(height, WIDTH_MIN).astype(np.int64)
+
+        x = np.round(center + page * geometry.page_width - width / 2).astype(np.int64)
+        y = geometry.bottom_line_y - (starts - page * self.time_limit) * bar_height
+        y = np.round(np.where(holds, y - height + WIDTH_HOLD_2, y - height / 2)).astype(np.int64)
+        layer = np.where(holds, NoteLayout.LAYER_HOLD, NoteLayout.LAYER_NOTE)
+        return NoteLayout(x, y, width, height, page, end_page, layer, center, unit)
+
+    def hold_rows(self, note: Note, geometry: PageGeometry, board_height, height):
+        # Rows [top, bottom) of the whole hold image, of the given height, that go to
+        # each page, and the y they are placed at. The caps only appear on the pages
+        # where the hold really starts and ends.
+        bar_height = geometry.bar_height * self.scale
+        bottom_line_y = geometry.bottom_line_y
+        page_number, end_page_number = self.page_range(note)
+
+        WIDTH_HOLD_2 = max(1, round(self.scale * Note.WIDTH_HOLD / 2))
+        cap_y = board_height - bottom_line_y
+        end_y = round(bottom_line_y - (note.end - end_page_number * self.time_limit) * bar_height - WIDTH_HOLD_2)
+        start_clip = round(((page_number + 1) * self.time_limit - note.start) * bar_height + WIDTH_HOLD_2)
+        end_clip = round((note.end - end_page_number * self.time_limit) * bar_height + WIDTH_HOLD_2)
+        pagesize = self.time_limit * bar_height
+
+        rows = [(page_number, height - start_clip, height, cap_y)]
+        for pg in range(page_number + 1, end_page_number):
+            cy = height - start_clip - (pg - page_number) * pagesize
+            rows.append((pg, round(cy), round(cy + pagesize), cap_y))
+        rows.append((end_page_number, 0, end_clip, end_y))
+        return rows
+
+    def hold_pieces(self, note: Note, center, width, height, geometry: PageGeometry, board_width, board_height, origin=0):
+        # Rows [row0, row1) of the whole hold image that go on the board, and where.
+        for pg, top, bottom, y in self.hold_rows(note, geometry, board_height, height):
+            row0, row1 = max(top, 0), min(bottom, height)
+            x = round(center + pg * geometry.page_width - width / 2) - origin
+            # Pages off the board, e.g. when rendering one page at a time, are not drawn.
+            if row0 >= row1 or x + width <= 0 or x >= board_width:
+                continue
+            yield x, y + row0 - top, row0, row1
+
+    def hold_segments(self, note: Note, center, unit, geometry: PageGeometry, board_width, board_height, origin=0):
+        params = note.image_params(round(unit), round(geometry.bar_height * self.scale), scale=self.scale)
+        for x, y, row0, row1 in self.hold_pieces(note, center, params[0], params[1], geometry, board_width, board_height, origin):
+            yield note.draw_segment(*params, top=row0, bottom=row1), x, y
+
+    def draw_notes(self, board: Image.Image, geometry: PageGeometry, chart: Chart, notes=None, origin=0):
+        bar_height = round(geometry.bar_height * self.scale)
+        if notes is None:
+            notes = chart.notes
+        layout = self.layout(chart, notes, geometry)
+        for i in layout.order():
+            note : Note = notes[i]
+            if layout.page[i] != layout.end_page[i]:
+                # Each page gets only its own part of the hold, drawn at its final size.
+                for segment, segment_x, segment_y in self.hold_segments(note, layout.center[i], layout.unit[i], geometry, board.width, board.height, origin):
+                    board.paste(segment, (segment_x, segment_y), mask=segment)
+                continue
+            if note.type == Note.NOTE_HOLD:
+                img = note.generate_image(round(layout.unit[i]), bar_height, scale=self.scale)
             else:
-                cap_y = board.height - bottom_line_y
-                end_y = round(bottom_line_y - (note.end - end_page_number * self.time_limit) * bar_height - WIDTH_HOLD_2)
-                start_clip = round(((page_number + 1) * self.time_limit - note.start) * bar_height + WIDTH_HOLD_2)
-                end_clip = round((note.end - end_page_number * self.time_limit) * bar_height + WIDTH_HOLD_2)
-                start_crop = img.crop((0, img.height - start_clip, img.width, img.height))
-                end_crop = img.crop((0, 0, img.width, end_clip))
-                board.paste(start_crop, (round(x + page_number * page_width - img.width / 2), cap_y), mask=start_crop)
-                board.paste(end_crop, (round(x + end_page_number * page_width - img.width / 2), end_y), mask=end_crop)
-
-                pagesize = self.time_limit * bar_height
-                for pg in range(page_number + 1, end_page_number):
-                    cy = img.height - start_clip - (pg - page_number) * pagesize
-                    crop = img.crop((0, round(cy), img.width, round(cy + pagesize)))
-                    board.paste(crop, (round(x + pg * page_width - img.width / 2), cap_y), mask=crop)
-        board.paste(board_front, (0, 0), mask=board_front)
+                img = self.sprite_cache.get(note, round(layout.unit[i]), bar_height, scale=self.scale)
+            board.paste(img, (int(layout.x[i]) - origin, int(layout.y[i])), mask=img)
+
+    def draw_notes_numpy(self, board: np.ndarray, geometry: PageGeometry, chart: Chart, notes=None, origin=0):
+        bar_height = round(geometry.bar_height * self.scale)
+        if notes is None:
+            notes = chart.notes
+        if not isinstance(notes, NoteArray):
+            notes = NoteArray(notes)
+        layout = self.layout(chart, notes, geometry)
+        board_height, board_width = board.shape[:2]
+
+        # Holds go first, in order, each cut from the template of its width.
+        for i in np.flatnonzero(layout.layer == NoteLayout.LAYER_HOLD):
+            note : Note = notes[i]
+            params = note.image_params(round(layout.unit[i]), bar_height, scale=self.scale)
+            width, height = params[0], params[1]
+            edge, template, binary = self.sprite_cache.get_hold_template(*params[:1], *params[2:])
+            if layout.page[i] == layout.end_page[i]:
+                pieces = [(int(layout.x[i]) - origin, int(layout.y[i]), 0, height)]
+            else:
+                pieces = self.hold_pieces(note, layout.center[i], width, height, geometry, board_width, board_height, origin)
+            for x, y, row0, row1 in pieces:
+                if height < template.shape[0]:
+                    img, short_binary = sprite_to_array(note.draw_segment(*params, top=row0, bottom=row1))
+                    _composite(board, img, x, y, short_binary)
+                else:
+                    _composite_hold(board, template, edge, binary, x, y, height, row0, row1)
+
+        # The other notes are grouped by sprite, and each group is written in one
+        # go. Notes that overlap another or leave the board keep their own draw
+        # in order, so the result is the same as pasting them one by one.
+        taps = np.flatnonzero(layout.layer == NoteLayout.LAYER_NOTE)
+        x, y = layout.x[taps] - origin, layout.y[taps]
+        width, height = layout.width[taps], layout.height[taps]
+        single = _overlapping(x, y, width, height) | (x < 0) | (y < 0) | (x + width > board_width) | (y + height > board_height)
+        keys = np.stack([notes.data['type'][taps].astype(np.int64), width, height], axis=1)
+        grouped = np.flatnonzero(~single)
+        if len(grouped):
+            _, group = np.unique(keys[grouped], axis=0, return_inverse=True)
+            group = group.reshape(-1)
+            pixels = board.view(np.uint32)[..., 0]
+            for members in np.split(grouped[np.argsort(group, kind='stable')], np.cumsum(np.bincount(group))[:-1]):
+                i = taps[members[0]]
+                img, binary = self.sprite_cache.get_array(notes[i], round(layout.unit[i]), bar_height, scale=self.scale)
+                if not binary:
+                    single[members] = True
+                    continue
+                rows, cols = np.nonzero(img[..., 3] == 255)
+                values = img.view(np.uint32)[rows, cols, 0]
+                offsets = rows * board_width + cols
+                pixels.put((y[members, None] * board_width + x[members, None] + offsets).ravel(), np.tile(values, len(members)))
+        for k in np.flatnonzero(single):
+            i = taps[k]
+            img, binary = self.sprite_cache.get_array(notes[i], round(layout.unit[i]), bar_height, scale=self.scale)
+            _composite(board, img, int(x[k]), int(y[k]), binary)
+
+
+def _generate_page_range(board: Board, chart: Chart, buckets, indices):
+    return [board.generate_page(chart, index, buckets) for index in indices]
+
+def _array_image(canvas: np.ndarray):
+    # Shares the canvas instead of copying it; Pillow copies on the first write.
+    return Image.frombuffer('RGBA', (canvas.shape[1], canvas.shape[0]), canvas, 'raw', 'RGBA', 0, 1)
+
+def _overlapping(x, y, width, height):
+    # Which rectangles overlap another. Sorted by top, a rectangle can only overlap
+    # the next few ones, until their top is past its bottom.
+    order = np.argsort(y, kind='stable')
+    x, y, width, height = x[order], y[order], width[order], height[order]
+    hits = np.zeros(len(order), dtype=bool)
+    for k in range(1, len(order)):
+        near = y[k:] < y[:-k] + height[:-k]
+        if not near.any():
+            break
+        hit = near & (x[k:] < x[:-k] + width[:-k]) & (x[:-k] < x[k:] + width[k:])
+        hits[k:] |= hit
+        hits[:-k] |= hit
+    res = np.empty_like(hits)
+    res[order] = hits
+    return res
+
+@lru_cache(maxsize=None)
+def _vertical_line_mask(width, height):
+    # Coverage of ImageDraw.line from (0, 0) to (0, height), by column offset.
+    pad = width + 2
+    img = Image.new('L', (2 * pad + 1, height), 0)
+    ImageDraw.Draw(img).line([(pad, 0), (pad, height)], fill=255, width=width)
+    mask = np.asarray(img) > 0
+    cols = np.flatnonzero(mask.any(axis=0))
+    return cols[0] - pad, mask[:, cols[0] : cols[-1] + 1]
+
+def _draw_vertical_line(board: np.ndarray, x, width, color):
+    offset, mask = _vertical_line_mask(width, board.shape[0])
+    x0, x1 = max(x + offset, 0), min(x + offset + mask.shape[1], board.shape[1])
+    if x0 < x1:
+        np.copyto(board[:, x0 : x1], np.array(color, dtype=np.uint8), where=mask[:, x0 - x - offset : x1 - x - offset, None])
+
+def _fill_mask(board: np.ndarray, color, mask: np.ndarray, x, y):
+    # Same as pasting a colour through an L mask with PIL.
+    mh, mw = mask.shape
+    bh, bw = board.shape[:2]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + mw, bw), min(y + mh, bh)
+    if x0 >= x1 or y0 >= y1:
+        return
+    alpha = mask[y0 - y : y1 - y, x0 - x : x1 - x, None].astype(np.uint32)
+    dst = board[y0 : y1, x0 : x1]
+    tmp = dst * (255 - alpha) + np.array(color, dtype=np.uint32) * alpha + 128
+    dst[...] = ((tmp >> 8) + tmp) >> 8
+
+def _composite_hold(board: np.ndarray, template: np.ndarray, edge, binary, x, y, height, row0=0, row1=None):
+    # Rows [row0, row1) of a hold of the given height, cut from its template (see
+    # SpriteCache.get_hold_template), with row0 placed at y.
+    if row1 is None:
+        row1 = height
+    shift = template.shape[0] - height
+    for start, stop in ((0, edge), (edge, height - edge), (height - edge, height)):
+        start, stop = max(start, row0), min(stop, row1)
+        if start >= stop:
+            continue
+        if start < edge:
+            rows = template[start : stop]
+        elif stop > height - edge:
+            rows = template[start + shift : stop + shift]
+        else:
+            rows = np.broadcast_to(template[edge : edge + 1], (stop - start,) + template.shape[1:])
+        _composite(board, rows, x, y + start - row0, binary)
+
+def _composite(board: np.ndarray, sprite: np.ndarray, x, y, binary=False):
+    sh, sw = sprite.shape[:2]
+    bh, bw = board.shape[:2]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + sw, bw), min(y + sh, bh)
+    if x0 >= x1 or y0 >= y1:
+        return
+    src = sprite[y0 - y : y1 - y, x0 - x : x1 - x]
+    dst = board[y0 : y1, x0 : x1]
+    if binary:
+        np.copyto(dst.view(np.uint32), src.view(np.uint32), where=src[..., 3:4] == 255)
+    else:
+        # Same rounding as PIL's paste with an RGBA mask.
+        alpha = src[..., 3:4].astype(np.uint32)
+        tmp = dst * (255 - alpha) + src * alpha + 128
+        dst[...] = ((tmp >> 8) + tmp) >> 8
@@ -1,4 +1,6 @@
+import io
 import json
+import numpy as np
 
 _Xml_head = """<?xml version="1.0" encoding="UTF-8" ?>
 <CMap xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema">"""
@@ -48,19 +50,24 @@ _Dic_note_type = {
     3: 'SUB',
 }
 
-def _get_meta_info(dic):
-    name = dic['m_Name']
+# Notes are formatted and written this many at a time.
+_Chunk_size = 1024
+
+def _meta_info(name, map_id, bpm, offset, left_region, right_region):
     if name[-2:] in ('_B', '_N', '_H', '_M', '_G'):
         name = name[:-2]
     return dict(
         title = name,
-        map_id = dic['m_mapID'],
-        bpm = dic['m_barPerMin'],
-        offset = dic['m_timeOffset'],
-        left_type = _Dic_region_type.get(dic['m_leftRegion'], _Dic_region_type[0]),
-        right_type = _Dic_region_type.get(dic['m_rightRegion'], _Dic_region_type[0]),
+        map_id = map_id,
+        bpm = bpm,
+        offset = offset,
+        left_type = _Dic_region_type.get(left_region, _Dic_region_type[0]),
+        right_type = _Dic_region_type.get(right_region, _Dic_region_type[0]),
     )
 
+def _get_meta_info(dic):
+    return _meta_info(dic['m_Name'], dic['m_mapID'], dic['m_barPerMin'], dic['m_timeOffset'], dic['m_leftRegion'], dic['m_rightRegion'])
+
 def _get_note_info(dic):
     return dict(
         id = dic['m_id'],
@@ -71,7 +78,27 @@ def _get_note_info(dic):
         sub_id = dic['m_subId'],
     )
 
-def convert_json(s : dict):
+def _write_document(fp, meta_dict, bottom, left, right):
+    # bottom, left and right yield the formatted notes of each side in chunks.
+    fp.write(f"""{_Xml_head}
+{_Xml_meta_info.format(**meta_dict)}
+""")
+    for head, chunks, tail in (
+        (_Xml_notes_bottom, bottom, _Xml_notes_bottom_tail),
+        (_Xml_notes_left, left, _Xml_notes_left_tail),
+        (_Xml_notes_right, right, _Xml_notes_right_tail),
+    ):
+        fp.write(f'{head}\n{_Xml_notes}\n')
+        for chunk in chunks:
+            fp.write(chunk)
+        fp.write(f'{_Xml_notes_tail}\n{tail}\n')
+    fp.write(_Xml_tail)
+
+def _json_notes(notes):
+    for i in range(0, len(notes), _Chunk_size):
+        yield ''.join(_Xml_note_info.format(**_get_note_info(n)) for n in notes[i : i + _Chunk_size])
+
+def write_json(fp, s : dict):
     if not isinstance(s, dict):
         dic = json.loads(s)
     else:
@@ -80,26 +107,51 @@ def convert_json(s : dict):
     bottom_notes = dic['m_notes']['m_notes']
     left_notes = dic['m_notesLeft']['m_notes']
     right_notes = dic['m_notesRight']['m_notes']
+    _write_document(fp, meta_dict, _json_notes(bottom_notes), _json_notes(left_notes), _json_notes(right_notes))
+    return meta_dict['map_id']
 
-    bottom = f"""{_Xml_notes_bottom}
-{_Xml_notes}
-{''.join((_Xml_note_info.format(**_get_note_info(n)) for n in bottom_notes))}{_Xml_notes_tail}
-{_Xml_notes_bottom_tail}"""
-    left = f"""{_Xml_notes_left}
-{_Xml_notes}
-{''.join((_Xml_note_info.format(**_get_note_info(n)) for n in left_notes))}{_Xml_notes_tail}
-{_Xml_notes_left_tail}"""
-    right = f"""{_Xml_notes_right}
-{_Xml_notes}
-{''.join((_Xml_note_info.format(**_get_note_info(n)) for n in right_notes))}{_Xml_notes_tail}
-{_Xml_notes_right_tail}"""
-
-    return f"""{_Xml_head}
-{_Xml_meta_info.format(**meta_dict)}
-{bottom}
-{left}
-{right}
-{_Xml_tail}""", meta_dict['map_id']
+def convert_json(s : dict):
+    fp = io.StringIO()
+    map_id = write_json(fp, s)
+    return fp.getvalue(), map_id
+
+def _chart_notes(ids, types, starts, ends, positions, widths, indices):
+    # Same entries as Chart.to_dict: a hold is followed by the SUB note at its end.
+    note_format = _Xml_note_info.format
+    for i in range(0, len(indices), _Chunk_size):
+        chunk = indices[i : i + _Chunk_size]
+        res = []
+        for id_, typ, start, end, position, width in zip(
+            ids[chunk].tolist(), types[chunk].tolist(), starts[chunk].tolist(), ends[chunk].tolist(),
+            positions[chunk].tolist(), widths[chunk].tolist(),
+        ):
+            if typ == 2:
+                res.append(note_format(id=id_, type='HOLD', time=start, position=position, width=width, sub_id=id_ + 1))
+                res.append(note_format(id=id_ + 1, type='SUB', time=end, position=position, width=width, sub_id=-1))
+            else:
+                res.append(note_format(id=id_, type=_Dic_note_type[typ], time=start, position=position, width=width, sub_id=-1))
+        yield ''.join(res)
+
+def write_chart(fp, chart):
+    # Writes a Chart straight from its note records, giving the same text as
+    # convert_json(chart.to_dict()).
+    meta_dict = _meta_info(
+        chart.name, chart.map_id, chart.bar_per_min, chart.time_offset,
+        1 if chart.left_slide else 2, 1 if chart.right_slide else 2,
+    )
+    data = chart.notes.data
+    types = data['type'].astype(int)
+    types[(types != 1) & (types != 2)] = 0
+    # A hold and its SUB note take two ids.
+    ids = np.cumsum(np.where(types == 2, 2, 1)) - np.where(types == 2, 2, 1)
+    positions = data['pos'] - data['width'] / 2
+    sides = data['side']
+    args = (ids, types, data['start'], data['end'], positions, data['width'])
+    bottom = np.flatnonzero((sides != -1) & (sides != 1))
+    left = np.flatnonzero(sides == -1)
+    right = np.flatnonzero(sides == 1)
+    _write_document(fp, meta_dict, _chart_notes(*args, bottom), _chart_notes(*args, left), _chart_notes(*args, right))
+    return meta_dict['map_id']
 
 if __name__ == '__main__':
     import sys, os
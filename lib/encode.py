@@ -0,0 +1,80 @@
+import os, time
+import tempfile
+import numpy as np
+from PIL import Image
+
+def _save_png(img : Image.Image, fp, compress_level=6):
+    img.save(fp, format='PNG', compress_level=compress_level)
+
+def _save_fast_png(img : Image.Image, fp):
+    _save_png(img, fp, compress_level=1)
+
+def to_palette(img : Image.Image):
+    # Boards only use the note and line colours plus the antialiased greys of the
+    # labels, which fit in a palette exactly. Pillow's own mapping to a fixed
+    # palette is approximate, so pixels are looked up by their packed RGBA value.
+    # Images with more colours are returned as RGBA rather than quantized lossily.
+    img = img.convert('RGBA')
+    colors = img.getcolors(256)
+    if colors is None:
+        return img
+    colors = sorted(color for _, color in colors)
+    keys = np.frombuffer(bytes(channel for color in colors for channel in color), dtype=np.uint32)
+    order = np.argsort(keys)
+    pixels = np.asarray(img).view(np.uint32)[..., 0]
+    indices = order[np.searchsorted(keys[order], pixels)].astype(np.uint8)
+    res = Image.fromarray(indices, 'P')
+    res.putpalette([channel for color in colors for channel in color[:3]])
+    alpha = bytes(color[3] for color in colors)
+    if alpha.count(255) != len(alpha):
+        res.info['transparency'] = alpha
+    return res
+
+def _save_palette_png(img : Image.Image, fp):
+    to_palette(img).save(fp, format='PNG', compress_level=3)
+
+# libwebp cannot encode images with a side longer than this.
+WEBP_MAX_SIZE = 16383
+
+def _save_webp(img : Image.Image, fp):
+    img.save(fp, format='WEBP', lossless=True, method=0, quality=0)
+
+def _save_raw(img : Image.Image, fp):
+    # Netpbm PAM: a plain text header followed by the uncompressed RGBA rows.
+    img = img.convert('RGBA')
+    header = f'P7\nWIDTH {img.width}\nHEIGHT {img.height}\nDEPTH 4\nMAXVAL 255\nTUPLTYPE RGB_ALPHA\nENDHDR\n'
+    fp.write(header.encode('ascii'))
+    fp.write(img.tobytes())
+
+PROFILES = {
+    'png': ('.png', _save_png),
+    'fast': ('.png', _save_fast_png),
+    'palette': ('.png', _save_palette_png),
+    'webp': ('.webp', _save_webp),
+    'raw': ('.pam', _save_raw),
+}
+
+def extension(profile='png'):
+    return PROFILES[profile][0]
+
+def save(img : Image.Image, path, profile='png'):
+    if profile not in PROFILES:
+        raise ValueError(f'Unknown output profile "{profile}".')
+    if profile == 'webp' and max(img.size) > WEBP_MAX_SIZE:
+        raise ValueError(f'{img.width}x{img.height} is too large for WebP (at most {WEBP_MAX_SIZE} pixels a side), use pages mode or another profile.')
+    _, saver = PROFILES[profile]
+    start_time = time.perf_counter()
+    # Encoded aside and moved in place, so a failure leaves no partial file.
+    fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            saver(img, fp)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    elapsed = time.perf_counter() - start_time
+    return elapsed, os.path.getsize(path)
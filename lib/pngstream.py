@@ -0,0 +1,94 @@
+import os
+import struct
+import zlib
+import numpy as np
+
+_Png_signature = b'\x89PNG\r\n\x1a\n'
+
+def _chunk(tag : bytes, data : bytes):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(data, zlib.crc32(tag)))
+
+class PngStreamWriter:
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, fp, width, height, compress_level=6):
+        self._own = isinstance(fp, (str, os.PathLike))
+        self.fp = open(fp, 'wb') if self._own else fp
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self._compressor = zlib.compressobj(compress_level)
+        self._pending = []
+        self._pending_size = 0
+        self._prev = np.zeros((1, width, 4), dtype=np.uint8)
+        self.fp.write(_Png_signature)
+        self.fp.write(_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self._own:
+            self.fp.close()
+
+    def _emit(self, data, force=False):
+        if data:
+            self._pending.append(data)
+            self._pending_size += len(data)
+        if self._pending_size >= self.CHUNK_SIZE or (force and self._pending_size):
+            self.fp.write(_chunk(b'IDAT', b''.join(self._pending)))
+            self._pending = []
+            self._pending_size = 0
+
+    def write(self, rows : np.ndarray):
+        rows = np.ascontiguousarray(rows, dtype=np.uint8)
+        assert rows.ndim == 3 and rows.shape[1:] == (self.width, 4), f'Expected rows of shape (n, {self.width}, 4), got {rows.shape}'
+        n = rows.shape[0]
+        if self.rows + n > self.height:
+            raise ValueError(f'Too many rows for a PNG of height {self.height}.')
+        # PNG "Up" filter: each row is stored as the difference to the row above.
+        prev = np.concatenate([self._prev, rows[:-1]], axis=0)
+        filtered = np.empty((n, self.width * 4 + 1), dtype=np.uint8)
+        filtered[:, 0] = 2
+        filtered[:, 1:] = (rows - prev).reshape(n, -1)
+        self._prev = rows[-1:].copy()
+        self.rows += n
+        self._emit(self._compressor.compress(filtered.tobytes()))
+
+    def close(self):
+        if self.rows != self.height:
+            raise ValueError(f'Only {self.rows} of {self.height} rows were written.')
+        self._emit(self._compressor.flush(), force=True)
+        self.fp.write(_chunk(b'IEND', b''))
+        if self._own:
+            self.fp.close()
+        else:
+            self.fp.flush()
+
+def write_pages(fp, pages, page_count, strip_height=256, compress_level=6):
+    # Pages are laid side by side, so every output row needs all pages. Each page is
+    # kept as compressed strips until the last one is rendered.
+    strips = []
+    page_size = None
+    for page in pages:
+        arr = np.asarray(page)
+        if page_size is None:
+            page_size = arr.shape[1], arr.shape[0]
+        strips.append([zlib.compress(arr[y : y + strip_height].tobytes(), 1) for y in range(0, arr.shape[0], strip_height)])
+        del arr
+    if len(strips) != page_count:
+        raise ValueError(f'Expected {page_count} pages, got {len(strips)}.')
+    if not strips:
+        return
+    page_width, page_height = page_size
+    with PngStreamWriter(fp, page_width * page_count, page_height, compress_level=compress_level) as writer:
+        for index, y in enumerate(range(0, page_height, strip_height)):
+            rows = min(strip_height, page_height - y)
+            strip = np.empty((rows, page_width * page_count, 4), dtype=np.uint8)
+            for pg, page_strips in enumerate(strips):
+                data = np.frombuffer(zlib.decompress(page_strips[index]), dtype=np.uint8)
+                strip[:, pg * page_width : (pg + 1) * page_width] = data.reshape(rows, page_width, 4)
+                page_strips[index] = None
+            writer.write(strip)
@@ -1,74 +1,207 @@
-from .chart import Note, Chart
+from .chart import Note, Chart, NoteArray, NOTE_DTYPE
+import hashlib
+import io
 import math
+import os
+import re
+import struct
+import tempfile
 from xml.etree import ElementTree
 import json
+import numpy as np
 
-def _read_notes(notes, matched, side):
-    holds = {}
-    subs = {}
-    max_time = 0.0
-    for xml_node in matched:
-        id_ = xml_node.find('m_id').text
-        typ = xml_node.find('m_type').text
-        time = xml_node.find('m_time').text
-        pos = xml_node.find('m_position').text
-        width = xml_node.find('m_width').text
-        subid = xml_node.find('m_subId').text
-
-        id_, subid = int(id_), int(subid)
-        time, pos, width = float(time), float(pos), float(width)
-        typ = typ.upper()
-        if typ == 'CHAIN':
-            typ = Note.NOTE_CHAIN
-        elif typ == 'HOLD':
-            typ = Note.NOTE_HOLD
-        elif typ == 'SUB':
-            subs[id_] = time
+_Dynamite_sides = {
+    'm_notes': Note.SIDE_FRONT,
+    'm_notesLeft': Note.SIDE_LEFT,
+    'm_notesRight': Note.SIDE_RIGHT,
+}
+
+class _DynamiteNotes:
+    # Notes of one side. Hold ends refer to SUB notes by id, so they are only
+    # known once the whole side has been read.
+    def __init__(self, side):
+        self.side = side
+        self.subs = {}
+        self.max_time = 0.0
+        self.data = None
+
+    def add_columns(self, ids, types, times, positions, widths, subids):
+        # A whole side at once, straight to note records. Values are parsed by
+        # int() and float() like the other readers.
+        ids, subids = list(map(int, ids)), list(map(int, subids))
+        times = np.array(list(map(float, times)), dtype=np.float64)
+        positions = np.array(list(map(float, positions)), dtype=np.float64)
+        widths = np.array(list(map(float, widths)), dtype=np.float64)
+        types = np.array(list(map(str.upper, types)))
+        subs = types == 'SUB'
+        for index in np.flatnonzero(subs).tolist():
+            self.subs[ids[index]] = times[index]
+        ends = times.copy()
+        # A later hold with the same id replaces an earlier one.
+        holds = {ids[index]: index for index in np.flatnonzero(types == 'HOLD').tolist()}
+        for index in holds.values():
+            sub = self.subs.get(subids[index], None)
+            if sub is not None:
+                ends[index] = sub
+        notes = ~subs
+        data = np.empty(np.count_nonzero(notes), dtype=NOTE_DTYPE)
+        data['type'] = np.where(types == 'CHAIN', Note.NOTE_CHAIN, np.where(types == 'HOLD', Note.NOTE_HOLD, Note.NOTE_NORMAL))[notes]
+        data['side'] = self.side
+        data['pos'] = (positions + widths / 2)[notes]
+        data['width'] = widths[notes]
+        data['start'] = times[notes]
+        data['end'] = ends[notes]
+        if len(data):
+            self.max_time = max(self.max_time, float(data['start'].max()))
+        self.data = data
+
+    def to_array(self):
+        if self.data is None:
+            return NoteArray()
+        return NoteArray.from_array(self.data)
+
+def _etree_read(source):
+    # One pass over a path or file object. Only end events are taken, as start
+    # events would double the work; notes are cut down to their fields as they
+    # end, and the tree left over is walked with find() like before.
+    fields = {}
+    containers = {}
+    parser = ElementTree.iterparse(source)
+    for _, elem in parser:
+        tag = elem.tag
+        if tag == 'CMapNoteAsset':
+            # The first of each field wins, like find().
+            values = {child.tag: child.text for child in reversed(elem)}
+            fields[elem] = tuple(values.get(field, _Missing) for field in _Note_fields)
+            elem.clear()
+        elif tag == 'm_notes':
+            rows = [fields.pop(child) for child in elem if child.tag == 'CMapNoteAsset']
+            if rows:
+                containers[elem] = rows
+                elem[:] = [child for child in elem if child.tag != 'CMapNoteAsset']
+    root = parser.root
+    meta = {}
+    for elem in root:
+        if elem.tag not in _Dynamite_sides:
+            meta.setdefault(elem.tag, elem.text)
+    sides = {}
+    for tag, side in _Dynamite_sides.items():
+        section = root.find(tag)
+        if section is None:
+            continue
+        notes = sides[tag] = _DynamiteNotes(side)
+        rows = containers.get(section.find('m_notes'), None)
+        if rows is None:
             continue
+        columns = list(zip(*rows))
+        for field, column in zip(_Note_fields, columns):
+            if any(value is _Missing for value in column):
+                raise ValueError(f'Some notes have no {field}.')
+        notes.add_columns(*columns)
+    return meta, sides
+
+_Missing = object()
+
+_Note_fields = ('m_id', 'm_type', 'm_time', 'm_position', 'm_width', 'm_subId')
+_Meta_fields = ('m_path', 'm_barPerMin', 'm_timeOffset', 'm_leftRegion', 'm_rightRegion', 'm_mapID')
+
+def _lxml_backend():
+    from lxml import etree
+
+    parser = etree.XMLParser(resolve_entities=False, huge_tree=True)
+    # Text has been decoded already, so its encoding declaration is ignored.
+    text_parser = etree.XMLParser(resolve_entities=False, huge_tree=True, encoding='utf8')
+    columns = [etree.XPath(f'CMapNoteAsset/{field}[1]/text()', smart_strings=False) for field in _Note_fields]
+    count = etree.XPath('count(CMapNoteAsset)')
+
+    def read(source):
+        # Parses the whole document in C, then takes every field of a side's
+        # notes with one XPath query each and converts them together.
+        if hasattr(source, 'read'):
+            data = source.read()
+            if isinstance(data, str):
+                root = etree.fromstring(data.encode('utf8'), text_parser)
+            else:
+                root = etree.fromstring(data, parser)
         else:
-            typ = Note.NOTE_NORMAL
-        note = Note(pos, type=typ, width=width, start=time, side=side)
-        if typ == Note.NOTE_HOLD:
-            holds[id_] = (note, subid)
-        notes.append(note)
-        max_time = max(max_time, time)
-    for note, subid in holds.values():
-        sub = subs.get(subid, None)
-        if sub is not None:
-            note.end = sub
-    return max_time
+            root = etree.parse(os.fspath(source), parser).getroot()
+        meta = {}
+        for field in _Meta_fields:
+            elem = root.find(field)
+            if elem is not None:
+                meta[field] = elem.text
+        sides = {}
+        for tag, side in _Dynamite_sides.items():
+            section = root.find(tag)
+            if section is None:
+                continue
+            notes = sides[tag] = _DynamiteNotes(side)
+            container = section.find('m_notes')
+            if container is None:
+                continue
+            values = [column(container) for column in columns]
+            size = int(count(container))
+            for field, column in zip(_Note_fields, values):
+                if len(column) != size:
+                    raise ValueError(f'Some notes have no {field}.')
+            notes.add_columns(*values)
+        return meta, sides
 
-def read_dynamite(s):
-    chart = Chart()
-    xml = ElementTree.fromstring(s)
+    return read
 
-    name = xml.find('m_path').text
-    barpermin = float(xml.find('m_barPerMin').text)
-    timeoffset = float(xml.find('m_timeOffset').text)
-    leftpad = xml.find('m_leftRegion').text
-    rightpad = xml.find('m_rightRegion').text
-    mapid = xml.find('m_mapID').text
+# XML parsers by name, fastest first. Each takes a path or file object and
+# returns the metadata fields and the notes of each side.
+XML_BACKENDS = {}
+try:
+    XML_BACKENDS['lxml'] = _lxml_backend()
+except ImportError:
+    pass
+XML_BACKENDS['etree'] = _etree_read
 
-    chart.name = name
-    chart.bar_per_min = barpermin
-    chart.time_offset = timeoffset
-    chart.left_slide = leftpad.lower() != 'pad'
-    chart.right_slide = rightpad.lower() != 'pad'
-    chart.map_id = mapid
+xml_backend = next(iter(XML_BACKENDS))
 
-    bottom_notes = xml.find('m_notes').find('m_notes').findall('CMapNoteAsset')
-    left_notes = xml.find('m_notesLeft').find('m_notes').findall('CMapNoteAsset')
-    right_notes = xml.find('m_notesRight').find('m_notes').findall('CMapNoteAsset')
+def set_xml_backend(name=None):
+    # None picks the fastest one available again.
+    global xml_backend
+    if name is None:
+        name = next(iter(XML_BACKENDS))
+    if name not in XML_BACKENDS:
+        raise ValueError(f'Unknown XML backend "{name}".')
+    xml_backend = name
 
-    t1 = _read_notes(chart.notes, bottom_notes, Note.SIDE_FRONT)
-    t2 = _read_notes(chart.notes, left_notes, Note.SIDE_LEFT)
-    t3 = _read_notes(chart.notes, right_notes, Note.SIDE_RIGHT)
+def read_dynamite(s, backend=None):
+    if isinstance(s, bytes):
+        return read_dynamite_file(io.BytesIO(s), backend)
+    return read_dynamite_file(io.StringIO(s), backend)
 
-    chart.time = math.ceil(max(t1, t2, t3, 1))
+def read_dynamite_file(source, backend=None):
+    if backend is None:
+        backend = xml_backend
+    if backend not in XML_BACKENDS:
+        raise ValueError(f'Unknown XML backend "{backend}".')
+    meta, sides = XML_BACKENDS[backend](source)
+
+    chart = Chart()
+    chart.name = meta['m_path']
+    chart.bar_per_min = float(meta['m_barPerMin'])
+    chart.time_offset = float(meta['m_timeOffset'])
+    chart.left_slide = meta['m_leftRegion'].lower() != 'pad'
+    chart.right_slide = meta['m_rightRegion'].lower() != 'pad'
+    chart.map_id = meta['m_mapID']
+
+    max_time = 1
+    for tag in _Dynamite_sides:
+        if tag in sides:
+            chart.notes.extend(sides[tag].to_array())
+            max_time = max(max_time, sides[tag].max_time)
+    chart.time = math.ceil(max_time)
+    # Charts are always handed out in Note order, so callers need not sort.
+    chart.sort()
 
     return chart
 
 def _dynamix_read_notes(notes, matched, side):
+    res = []
     holds = {}
     subs = {}
     max_time = 0.0
@@ -92,12 +225,13 @@ def _dynamix_read_notes(notes, matched, side):
         note = Note(pos, type=typ, width=width, start=time, side=side)
         if typ == Note.NOTE_HOLD:
             holds[id_] = (note, subid)
-        notes.append(note)
+        res.append(note)
         max_time = max(max_time, time)
     for note, subid in holds.values():
         sub = subs.get(subid, None)
         if sub is not None:
             note.end = sub
+    notes.extend(res)
     return max_time
 
 def read_dynamix(s : dict):
@@ -128,17 +262,199 @@ def read_dynamix(s : dict):
     t3 = _dynamix_read_notes(chart.notes, right_notes, Note.SIDE_RIGHT)
 
     chart.time = math.ceil(max(t1, t2, t3, 1))
+    # Charts are always handed out in Note order, so callers need not sort.
+    chart.sort()
 
     return chart
 
+_Sniff_size = 1 << 12
+_Re_blank = re.compile(r'[\s\ufeff]*')
+_Re_blank_bytes = re.compile(rb'(?:\s|\xef\xbb\xbf)*')
+
+def _sniff(head):
+    # The format is told by the first character that is not whitespace or a BOM;
+    # '' means head is blank and more input is needed.
+    blank = _Re_blank_bytes if isinstance(head, bytes) else _Re_blank
+    index = blank.match(head).end()
+    first = head[index : index + 1]
+    if first in ('<', b'<'):
+        return 'xml'
+    if first in ('{', b'{'):
+        return 'json'
+    if not first:
+        return ''
+    return None
+
 def read(chart):
+    # chart is the text of a chart, or a seekable file object to read it from.
+    if hasattr(chart, 'read'):
+        head = chart.read(_Sniff_size)
+        fmt = _sniff(head)
+        while fmt == '' and head:
+            head = chart.read(_Sniff_size)
+            fmt = _sniff(head)
+        chart.seek(0)
+        if fmt == 'xml':
+            return read_dynamite_file(chart)
+        if fmt == 'json':
+            return read_dynamix(json.load(chart))
+    else:
+        fmt = _sniff(chart)
+        if fmt == 'xml':
+            return read_dynamite(chart)
+        if fmt == 'json':
+            return read_dynamix(json.loads(chart))
+    raise ValueError(f'Chart is neither XML format nor JSON format.')
+
+# Binary charts: a header, the name and map id in UTF-8, then one NOTE_DTYPE
+# record per note, so the notes can be memory-mapped as they are. The header
+# also stamps the source the chart was read from.
+_Binary_magic = b'DCHB'
+_Binary_version = 2
+# The stamp is the source's mtime, size, encoding tag and hash; see _source_stamp.
+_Binary_header = struct.Struct('<4sHHdddQqq8s32sii')
+_Binary_stamp_offset = struct.calcsize('<4sHHdddQ')
+_Binary_stamp = struct.Struct('<qq8s32s')
+
+_Flag_left_slide = 1
+_Flag_right_slide = 2
+# Readers may give ints for these, which print differently in XML.
+_Flag_int_bar_per_min = 4
+_Flag_int_time_offset = 8
+_Flag_int_time = 16
+
+_No_stamp = (0, 0, bytes(8), bytes(32))
+
+def _number(value, flag):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f'cannot store {value!r} in a binary chart')
+    return float(value), flag if isinstance(value, int) else 0
+
+def _text(value):
+    if value is None:
+        return b'', -1
+    if not isinstance(value, str):
+        raise ValueError(f'cannot store {value!r} in a binary chart')
+    data = value.encode('utf8')
+    return data, len(data)
+
+def write_binary(fp, chart : Chart, stamp=_No_stamp):
+    bar_per_min, int_bar_per_min = _number(chart.bar_per_min, _Flag_int_bar_per_min)
+    time_offset, int_time_offset = _number(chart.time_offset, _Flag_int_time_offset)
+    time, int_time = _number(chart.time, _Flag_int_time)
+    flags = int_bar_per_min | int_time_offset | int_time
+    if chart.left_slide:
+        flags |= _Flag_left_slide
+    if chart.right_slide:
+        flags |= _Flag_right_slide
+    name, name_size = _text(chart.name)
+    map_id, map_id_size = _text(chart.map_id)
+    data = chart.notes.data
+    fp.write(_Binary_header.pack(_Binary_magic, _Binary_version, flags, bar_per_min, time_offset, time, len(data), *stamp, name_size, map_id_size))
+    fp.write(name)
+    fp.write(map_id)
+    fp.write(data.tobytes())
+
+def _read_binary_header(fp):
+    head = fp.read(_Binary_header.size)
+    if len(head) != _Binary_header.size:
+        raise ValueError('Binary chart is truncated.')
+    magic, version, flags, bar_per_min, time_offset, time, count, *rest = _Binary_header.unpack(head)
+    if magic != _Binary_magic or version != _Binary_version:
+        raise ValueError('Not a binary chart of this version.')
+    mtime, size, tag, digest, name_size, map_id_size = rest
+    chart = Chart()
+    chart.bar_per_min = int(bar_per_min) if flags & _Flag_int_bar_per_min else bar_per_min
+    chart.time_offset = int(time_offset) if flags & _Flag_int_time_offset else time_offset
+    chart.time = int(time) if flags & _Flag_int_time else time
+    chart.left_slide = bool(flags & _Flag_left_slide)
+    chart.right_slide = bool(flags & _Flag_right_slide)
+    chart.name = _read_text(fp, name_size)
+    chart.map_id = _read_text(fp, map_id_size)
+    # A file cut short, e.g. by a crash while writing it, would map past its end.
+    if os.fstat(fp.fileno()).st_size != fp.tell() + count * NOTE_DTYPE.itemsize:
+        raise ValueError('Binary chart is truncated.')
+    return chart, count, (mtime, size, tag, digest)
+
+def _read_text(fp, size):
+    if size < 0:
+        return None
+    data = fp.read(size)
+    if len(data) != size:
+        raise ValueError('Binary chart is truncated.')
+    return data.decode('utf8')
+
+def read_binary(path):
+    # The notes are mapped read-only and copied on the first change.
+    with open(path, 'rb') as fp:
+        chart, count, _ = _read_binary_header(fp)
+        offset = fp.tell()
+    if count:
+        data = np.memmap(path, dtype=NOTE_DTYPE, mode='r', offset=offset, shape=(count,))
+        chart.notes = NoteArray.from_readonly(data)
+    return chart
+
+def _source_stamp(path, encoding, stat=None):
+    if stat is None:
+        stat = os.stat(path)
+    h = hashlib.sha256(encoding.encode())
+    with open(path, 'rb') as fp:
+        while (chunk := fp.read(1 << 20)):
+            h.update(chunk)
+    return stat.st_mtime_ns, stat.st_size, _encoding_tag(encoding), h.digest()
+
+def _encoding_tag(encoding):
+    # Lets the mtime and size check tell apart sidecars decoded another way.
+    return hashlib.sha256(encoding.encode()).digest()[:8]
+
+def cache_path(path):
+    return f'{path}.dchb'
+
+def read_cached(path, encoding='utf8'):
+    # Reads a chart file through a binary sidecar next to it. The sidecar is
+    # used while the source keeps its mtime, size and encoding, or failing that
+    # its hash, and is written again otherwise.
+    cache = cache_path(path)
+    stat = os.stat(path)
+    try:
+        with open(cache, 'rb') as fp:
+            _, _, (mtime, size, tag, digest) = _read_binary_header(fp)
+    except (OSError, ValueError):
+        mtime = None
+    stamp = None
+    if mtime is not None:
+        if (mtime, size, tag) == (stat.st_mtime_ns, stat.st_size, _encoding_tag(encoding)):
+            return read_binary(cache)
+        stamp = _source_stamp(path, encoding, stat)
+        if stamp[3] == digest:
+            # Touched but not changed: keep the records, refresh the stamp.
+            try:
+                with open(cache, 'r+b') as fp:
+                    fp.seek(_Binary_stamp_offset)
+                    fp.write(_Binary_stamp.pack(*stamp))
+            except OSError:
+                pass
+            return read_binary(cache)
+    with open(path, 'r', encoding=encoding) as fp:
+        chart = read(fp)
+    if stamp is None:
+        stamp = _source_stamp(path, encoding, stat)
     try:
-        _ = ElementTree.fromstring(chart)
-        reader = read_dynamite
-    except:
+        # Written aside and moved in place, so charts mapped from the old file
+        # stay intact.
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
         try:
-            _ = json.loads(chart)
-            reader = read_dynamix
-        except:
-            raise ValueError(f'Chart is neither XML format nor JSON format.')
-    return reader(chart)
+            with os.fdopen(fd, 'wb') as fp:
+                write_binary(fp, chart, stamp)
+            # mkstemp creates the file private to its owner; give the sidecar the
+            # mode of any other new file instead.
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0o666 & ~umask)
+            os.replace(tmp, cache)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    except (OSError, ValueError):
+        pass
+    return chart
@@ -0,0 +1,122 @@
+import os, shutil, tempfile
+import hashlib
+import struct
+
+from .chart import Chart, Board
+
+def chart_digest(chart : Chart, *extra):
+    h = hashlib.sha256()
+    h.update(struct.pack('<dd', chart.bar_per_min, chart.time_offset))
+    h.update(repr(chart.time).encode())
+    h.update(chart.notes.data.tobytes())
+    for item in extra:
+        h.update(repr(item).encode())
+    return h.hexdigest()
+
+class RenderCache:
+    DEFAULT_MAX_SIZE = 1 << 30
+    # Eviction past the cap goes down to this fraction of it, so a full cache is
+    # not scanned again on every store.
+    EVICT_RATIO = 0.9
+
+    @staticmethod
+    def default_directory():
+        path = os.environ.get('DYNACHART_CACHE', None)
+        if path:
+            return path
+        return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'dynachart')
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        if directory is None:
+            directory = self.default_directory()
+        self.directory = directory
+        self.max_size = max_size
+        # Running size of the cache, counted once and then kept up by store().
+        self._total = None
+
+    def key(self, chart : Chart, board : Board, *extra):
+        return chart_digest(chart, board.render_params(), *extra)
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, key, targets):
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return False
+        try:
+            names = sorted(os.listdir(entry), key=lambda x: int(x.split('.', 1)[0]))
+        except ValueError:
+            # A stray file in the entry, treated as a miss.
+            return False
+        if len(names) != len(targets):
+            return False
+        for name, target in zip(names, targets):
+            shutil.copyfile(os.path.join(entry, name), target)
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return True
+
+    def store(self, key, sources):
+        os.makedirs(self.directory, exist_ok=True)
+        entry = self._entry(key)
+        tmp = tempfile.mkdtemp(prefix='.tmp', dir=self.directory)
+        size = 0
+        try:
+            for index, source in enumerate(sources):
+                ext = os.path.splitext(source)[1]
+                shutil.copyfile(source, os.path.join(tmp, f'{index}{ext}'))
+                size += os.path.getsize(source)
+            os.rename(tmp, entry)
+        except OSError:
+            # Another process stored the same entry first.
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        if self.max_size is None:
+            return
+        if self._total is None:
+            self._total = self.size()
+        else:
+            self._total += size
+        # The directory is only scanned again once the cap is passed.
+        if self._total > self.max_size:
+            self.evict(self.max_size * self.EVICT_RATIO)
+
+    def size(self):
+        return sum(size for _, _, size in self._entries())
+
+    def _entries(self):
+        res = []
+        if not os.path.isdir(self.directory):
+            return res
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                res.append((os.path.getmtime(path), path, size))
+            except OSError:
+                continue
+        return res
+
+    def evict(self, target=None):
+        if self.max_size is None:
+            return
+        if target is None:
+            target = self.max_size
+        entries = sorted(self._entries())
+        total = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if total <= target:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        self._total = total
+
+    def clear(self):
+        for _, path, _ in self._entries():
+            shutil.rmtree(path, ignore_errors=True)
+        self._total = None
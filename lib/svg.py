@@ -0,0 +1,174 @@
+import io
+import os
+import numpy as np
+
+from .chart import Note, Chart, Board
+
+def _num(v):
+    res = f'{v:.2f}'.rstrip('0').rstrip('.')
+    return '0' if res == '-0' else res
+
+def _color(color):
+    return '#%02x%02x%02x' % tuple(color[:3])
+
+def _line_width(board: Board, width):
+    return max(1, round(board.scale * width))
+
+class SvgWriter:
+    # Writes a Board as SVG, one <g> per page. Page grids only depend on the bar
+    # offset of the page, so they are written once to <defs> and reused.
+    def __init__(self, board: Board, fp):
+        self.board = board
+        self._own = isinstance(fp, (str, os.PathLike))
+        self.fp = open(fp, 'w', encoding='utf8') if self._own else fp
+        self.geometry = board.page_geometry()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._own:
+            self.fp.close()
+
+    def _style(self):
+        board = self.board
+        rules = [
+            f'.bg{{fill:{_color(board.BACKGROUND_COLOR)}}}',
+            f'.l{{stroke:{_color(board.LINE_COLOR)};fill:none}}',
+            f'.b{{stroke:{_color(board.BAR_LINE_COLOR)};stroke-width:{_line_width(board, board.BAR_LINE_WIDTH)};fill:none}}',
+            f'.sb{{stroke:{_color(board.SEMI_BAR_LINE_COLOR)};stroke-width:{_line_width(board, board.SEMI_BAR_LINE_WIDTH)};fill:none}}',
+            f'.sp{{stroke:{_color(board.SPLIT_LINE_COLOR)};stroke-width:{_line_width(board, board.SPLIT_LINE_WIDTH)};fill:none}}',
+            f'.t{{fill:{_color(board.FONT_COLOR)};font-family:Arial,sans-serif;font-size:{round(board.FONT_SIZE * board.scale)}px;text-anchor:end;dominant-baseline:central}}',
+            f'.n{{fill:{_color(Note.COLOR_NORMAL)}}}',
+            f'.c{{fill:{_color(Note.COLOR_CHAIN)}}}',
+            f'.h{{fill:{_color(Note.COLOR_HOLD_FILL)};stroke:{_color(Note.COLOR_HOLD_BOARD)}}}',
+        ]
+        return '<style>' + ''.join(rules) + '</style>\n'
+
+    def _grid(self, bar_offset):
+        # Same lines as Board.draw_page.
+        board, geometry = self.board, self.geometry
+        page_width, bottom_line_y = geometry.page_width, geometry.bottom_line_y
+        page_bottom = geometry.page_height - bottom_line_y
+        bar_height = geometry.bar_height * board.scale
+        bars, semi_bars = [], []
+        for i in range(bar_offset, board.time_limit, board.bar_span):
+            y = bottom_line_y - bar_height * i
+            if i != 0:
+                bars.append(f'M0 {_num(y)}H{page_width}')
+            if board.semi_bar_span and board.semi_bar_span > 0:
+                for j in np.arange(board.semi_bar_span, board.bar_span, board.semi_bar_span):
+                    semi_bars.append(f'M0 {_num(y - bar_height * j)}H{page_width}')
+        sides = ''.join(
+            f'M{x} {page_bottom}V{bottom_line_y}'
+            for x in (geometry.side_line_leftside_x, geometry.side_line_left_x, geometry.side_line_right_x, geometry.side_line_rightside_x)
+        )
+        res = f'<g id="grid{bar_offset}">'
+        res += f'<rect class="bg" width="{page_width}" height="{geometry.page_height}"/>'
+        res += f'<path class="l" stroke-width="{_line_width(board, board.BOTTOM_LINE_WIDTH)}" d="M0 {bottom_line_y}H{page_width}M0 {page_bottom}H{page_width}"/>'
+        res += f'<path class="l" stroke-width="{_line_width(board, board.SIDE_LINE_WIDTH)}" d="{sides}"/>'
+        if bars:
+            res += f'<path class="b" d="{"".join(bars)}"/>'
+        if semi_bars:
+            res += f'<path class="sb" d="{"".join(semi_bars)}"/>'
+        return res + '</g>\n'
+
+    def _defs(self, pages):
+        board, geometry = self.board, self.geometry
+        offsets = sorted(set((-i * board.time_limit) % board.bar_span for i in range(pages)))
+        res = '<defs>\n'
+        res += f'<clipPath id="page"><rect width="{geometry.page_width}" height="{geometry.page_height}"/></clipPath>\n'
+        # Parts of holds that continue on another page are cut at the top and/or
+        # bottom line, like Board.hold_segments does.
+        cap_y = geometry.page_height - geometry.bottom_line_y
+        res += f'<clipPath id="ht"><rect y="{cap_y}" width="{geometry.page_width}" height="{geometry.page_height - cap_y}"/></clipPath>\n'
+        res += f'<clipPath id="hb"><rect width="{geometry.page_width}" height="{geometry.bottom_line_y}"/></clipPath>\n'
+        res += f'<clipPath id="hm"><rect y="{cap_y}" width="{geometry.page_width}" height="{geometry.bottom_line_y - cap_y}"/></clipPath>\n'
+        for offset in offsets:
+            res += self._grid(offset)
+        return res + '</defs>\n'
+
+    def _labels(self, chart: Chart, index):
+        board, geometry = self.board, self.geometry
+        # Anchored at their right middle, like Board.draw_label.
+        font_size = round(board.FONT_SIZE * board.scale)
+        res = []
+        first_bar = -(-index * board.time_limit // board.bar_span) * board.bar_span
+        for i in range(first_bar, (index + 1) * board.time_limit, board.bar_span):
+            y = geometry.bottom_line_y - geometry.bar_height * board.scale * (i - index * board.time_limit)
+            res.append(f'<text class="t" x="{_num(geometry.side_line_left_x - font_size / 2)}" y="{_num(y - font_size)}">{board.bar_label(chart, i)}</text>')
+        return ''.join(res)
+
+    def _rect(self, note: Note, x, y, params, clip=None):
+        width, height, radius, _, _, line_width = params
+        attrs = f' clip-path="url(#{clip})"' if clip else ''
+        if note.type == Note.NOTE_HOLD:
+            # PIL draws outlines inside the shape, SVG strokes are centred on it.
+            inset = line_width / 2
+            return (f'<rect class="h" x="{_num(x + inset)}" y="{_num(y + inset)}" width="{_num(max(width - line_width, 0))}" '
+                    f'height="{_num(max(height - line_width, 0))}" rx="{_num(max(radius - inset, 0))}" stroke-width="{line_width}"{attrs}/>')
+        cls = 'c' if note.type == Note.NOTE_CHAIN else 'n'
+        return f'<rect class="{cls}" x="{x}" y="{y}" width="{width}" height="{height}" rx="{radius}"{attrs}/>'
+
+    def _notes(self, chart: Chart, index, notes):
+        board, geometry = self.board, self.geometry
+        page_width, page_height = geometry.page_width, geometry.page_height
+        origin = index * page_width
+        bar_height = round(geometry.bar_height * board.scale)
+        layout = board.layout(chart, notes, geometry)
+        res = []
+        for i in layout.order():
+            note = notes[i]
+            params = note.image_params(round(layout.unit[i]), bar_height, scale=board.scale)
+            width, height = params[0], params[1]
+            if layout.page[i] == layout.end_page[i]:
+                res.append(self._rect(note, int(layout.x[i]) - origin, int(layout.y[i]), params))
+                continue
+            page_number, end_page_number = int(layout.page[i]), int(layout.end_page[i])
+            for pg, top, bottom, y in board.hold_rows(note, geometry, page_height, height):
+                x = round(layout.center[i] + pg * page_width - width / 2) - origin
+                if x + width <= 0 or x >= page_width:
+                    continue
+                clip = 'hm'
+                if pg == page_number:
+                    clip = 'ht'
+                elif pg == end_page_number:
+                    clip = 'hb'
+                res.append(self._rect(note, x, y - top, params, clip))
+        return '\n'.join(res)
+
+    def write(self, chart: Chart):
+        board, geometry = self.board, self.geometry
+        buckets = board.bucket_notes(chart)
+        pages = len(buckets)
+        width, height = geometry.page_width * pages, geometry.page_height
+        fp = self.fp
+        fp.write(f'<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" width="{width}" height="{height}" viewBox="0 0 {width} {height}">\n')
+        fp.write(self._style())
+        fp.write(self._defs(pages))
+        for index in range(pages):
+            fp.write(f'<g id="page{index}" transform="translate({index * geometry.page_width} 0)" clip-path="url(#page)">\n')
+            fp.write(f'<use xlink:href="#grid{(-index * board.time_limit) % board.bar_span}"/>\n')
+            fp.write(self._labels(chart, index) + '\n')
+            # Same split lines as Board.draw_board_page, below the notes.
+            split = ''
+            if index > 0:
+                split += f'M0 0V{height}'
+            if index < pages - 1:
+                split += f'M{geometry.page_width} 0V{height}'
+            if split:
+                fp.write(f'<path class="sp" d="{split}"/>\n')
+            notes = chart.notes[buckets[index]]
+            if notes:
+                fp.write(self._notes(chart, index, notes) + '\n')
+            fp.write('</g>\n')
+        fp.write('</svg>\n')
+
+def write_svg(fp, board: Board, chart: Chart):
+    with SvgWriter(board, fp) as writer:
+        writer.write(chart)
+
+def to_svg(board: Board, chart: Chart):
+    fp = io.StringIO()
+    write_svg(fp, board, chart)
+    return fp.getvalue()
@@ -0,0 +1,140 @@
+import copy
+import os
+import shutil
+import subprocess
+import tempfile
+from math import ceil
+import numpy as np
+from PIL import Image, ImageDraw
+
+from .chart import Chart, Board, AudioFile
+
+_Video_options = {
+    '.mp4': ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-movflags', '+faststart'],
+    '.mkv': ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2'],
+    '.webm': ['-c:v', 'libvpx-vp9', '-deadline', 'realtime', '-pix_fmt', 'yuv420p', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2'],
+    '.gif': ['-vf', 'split[a][b];[a]palettegen=reserve_transparent=0[p];[b][p]paletteuse=dither=none'],
+}
+
+_Audio_options = {
+    '.mp4': ['-c:a', 'aac', '-b:a', '192k'],
+    '.mkv': ['-c:a', 'aac', '-b:a', '192k'],
+    '.webm': ['-c:a', 'libopus', '-b:a', '128k'],
+}
+
+class ScrollRenderer:
+    # Gameplay-style previews: the chart scrolls down onto the bottom line in sync
+    # with the song. The whole chart is drawn once as a single tall page, and every
+    # frame is a window of its rows.
+    FORMATS = tuple(ext[1:] for ext in _Video_options)
+
+    def __init__(self, board: Board, fps=30, visible_bars=4):
+        self.board = board
+        self.fps = fps
+        self.visible_bars = visible_bars
+        self._strip = None
+        self._geometry = None
+        self._key = None
+
+    def strip_board(self, chart: Chart):
+        # Copying goes through Board.__getstate__, so the caches of the original
+        # board are neither shared nor filled with one-off templates.
+        board = copy.copy(self.board)
+        board.time_limit = max(1, ceil(chart.time))
+        return board
+
+    def strip(self, chart: Chart):
+        board = self.strip_board(chart)
+        img = board.generate(chart)
+        self._strip = np.asarray(img.convert('RGBA'))
+        self._geometry = board.page_geometry()
+        self._key = (chart, chart.notes.version)
+        return self._strip
+
+    def cached_strip(self, chart: Chart):
+        # The strip is kept for the chart it was drawn from, and redrawn for any
+        # other chart or once the notes of that one are edited.
+        if self._strip is None or self._key != (chart, chart.notes.version):
+            return self.strip(chart)
+        return self._strip
+
+    def frame_size(self):
+        geometry = self._geometry
+        page_bottom = geometry.page_height - geometry.bottom_line_y
+        height = round(self.visible_bars * geometry.bar_height * self.board.scale) + 2 * page_bottom
+        return geometry.page_width, height
+
+    def duration(self, chart: Chart):
+        # Seconds until the end of the last bar, see Board.bar_label.
+        return max(0.0, chart.time / chart.bar_per_min * 60 - chart.time_offset)
+
+    def frame_count(self, chart: Chart, duration=None):
+        if duration is None:
+            duration = self.duration(chart)
+        return ceil(duration * self.fps)
+
+    def judge_line(self, width, height, judge_y):
+        # The bottom line stays put while the chart scrolls; these are its rows
+        # in a frame, with their coverage for the antialiased edges.
+        overlay = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+        line_width = max(1, round(self.board.scale * Board.BOTTOM_LINE_WIDTH))
+        ImageDraw.Draw(overlay).line([(0, judge_y), (width, judge_y)], fill=Board.LINE_COLOR, width=line_width)
+        overlay = np.asarray(overlay)
+        rows = np.flatnonzero(overlay[..., 3].any(axis=1))
+        top, bottom = rows[0], rows[-1] + 1
+        return top, overlay[top : bottom], overlay[top : bottom, :, 3:] > 0
+
+    def frames(self, chart: Chart, duration=None):
+        strip = self.cached_strip(chart)
+        geometry = self._geometry
+        width, height = self.frame_size()
+        bar_height = geometry.bar_height * self.board.scale
+        judge_y = height - (geometry.page_height - geometry.bottom_line_y)
+        line_top, line, line_mask = self.judge_line(width, height, judge_y)
+        line_bottom = line_top + line.shape[0]
+        # Every frame is copied into one buffer, padded with the background where
+        # it reaches past the strip, and the bottom line is stamped over it.
+        frame = np.empty((height, width, 4), dtype=np.uint8)
+        for index in range(self.frame_count(chart, duration)):
+            t = index / self.fps
+            bar = (t + chart.time_offset) * chart.bar_per_min / 60
+            y0 = round(geometry.bottom_line_y - bar * bar_height) - judge_y
+            top, bottom = max(y0, 0), min(y0 + height, strip.shape[0])
+            if top - y0 > 0 or bottom - y0 < height:
+                frame[...] = Board.BACKGROUND_COLOR
+            if top < bottom:
+                frame[top - y0 : bottom - y0] = strip[top : bottom]
+            np.copyto(frame[line_top : line_bottom], line, where=line_mask)
+            yield frame
+
+    def command(self, path, audio_path=None, ffmpeg='ffmpeg'):
+        ext = os.path.splitext(str(path))[1].lower()
+        if ext not in _Video_options:
+            raise ValueError(f'Unsupported video format "{ext}".')
+        width, height = self.frame_size()
+        cmd = [ffmpeg, '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', f'{width}x{height}', '-r', str(self.fps), '-i', '-']
+        if audio_path is not None and ext in _Audio_options:
+            cmd += ['-i', audio_path, '-map', '0:v', '-map', '1:a', *_Audio_options[ext], '-shortest']
+        return cmd + _Video_options[ext] + [str(path)]
+
+    def write(self, path, chart: Chart, audio: AudioFile = None, ffmpeg='ffmpeg'):
+        if shutil.which(ffmpeg) is None:
+            raise FileNotFoundError(f'"{ffmpeg}" is not found.')
+        self.cached_strip(chart)
+        duration = audio.duration if audio is not None and audio.valid else None
+        with tempfile.TemporaryDirectory() as tmp:
+            audio_path = None
+            if duration is not None:
+                audio_path = os.path.join(tmp, 'audio.wav')
+                audio.to(audio_path, format='wav')
+            proc = subprocess.Popen(self.command(path, audio_path, ffmpeg), stdin=subprocess.PIPE)
+            try:
+                for frame in self.frames(chart, duration):
+                    proc.stdin.write(frame.data)
+            except BrokenPipeError:
+                pass
+            finally:
+                proc.stdin.close()
+                code = proc.wait()
+        if code != 0:
+            raise RuntimeError(f'ffmpeg exited with code {code}.')
@@ -1,12 +1,206 @@
 from lib.reader import *
-from lib.chart import Board
+from lib.chart import Board, AudioFile
+from lib.pngstream import write_pages
+from lib.svg import write_svg
+from lib.video import ScrollRenderer
+from lib.rendercache import RenderCache
+from lib import encode
 import json
+import os, sys, glob, time
+from concurrent.futures import ProcessPoolExecutor
 from xml.etree import ElementTree
 
+_Chart_extensions = ('.xml', '.json')
+
+def collect_files(patterns):
+    files = []
+    seen = set()
+    def add(f):
+        key = os.path.abspath(f)
+        if key not in seen:
+            seen.add(key)
+            files.append(f)
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, names in os.walk(pattern):
+                dirs.sort()
+                for name in sorted(names):
+                    if name.lower().endswith(_Chart_extensions):
+                        add(os.path.join(root, name))
+        elif glob.has_magic(pattern):
+            for f in sorted(glob.glob(pattern, recursive=True)):
+                if os.path.isfile(f):
+                    add(f)
+        else:
+            add(pattern)
+    return files
+
+def _output_stem(f):
+    fname = os.path.basename(f)
+    if (pt := fname.rfind('.')) != -1:
+        return fname[:pt]
+    return fname
+
+_Output_backends = (*Board.BACKENDS, 'svg')
+
+def make_board(args):
+    # SVG output is written from the board's layout; no raster backend is involved.
+    backend = 'pil' if args.backend == 'svg' else args.backend
+    return Board(scale=args.scale, time_limit=args.page_limit, speed=args.speed, bar_span=args.bar_span, semi_bar_span=args.semi_bar_span, backend=backend)
+
+def read_file(f, args):
+    if not args.no_cache:
+        return read_cached(f, args.encoding)
+    with open(f, 'r', encoding=args.encoding) as F:
+        return read(F)
+
+def _format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f'{size:.0f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GB'
+
+_Stream_compress_level = {
+    'png': 6,
+    'fast': 1,
+}
+
+def render_file(f, args, cache=None):
+    if not os.path.isfile(f):
+        return False, f'File "{f}" is not found.'
+    try:
+        if args.backend == 'svg':
+            if args.scales or args.page_mode != 'board':
+                raise ValueError('svg output is a single file with a group per page')
+            profile, ext = 'svg', '.svg'
+        else:
+            profile = args.profile or 'png'
+            if args.page_mode == 'stream' and not args.scales and profile not in _Stream_compress_level:
+                raise ValueError(f'profile "{profile}" cannot be streamed')
+            ext = encode.extension(profile)
+        fstem = _output_stem(f)
+        ftarget = fstem + ext
+        chart = read_file(f, args)
+
+        board = make_board(args)
+        if args.video:
+            target = f'{fstem}.{args.video}'
+            audio = AudioFile.from_file(args.audio) if args.audio else None
+            ScrollRenderer(board, fps=args.fps).write(os.path.join(os.path.dirname(f), target), chart, audio)
+            return True, f'Preview saved to "{target}".'
+        if args.scales:
+            targets = [os.path.join(os.path.dirname(f), f'{fstem}@{scale:g}{ext}') for scale in args.scales]
+            ftarget = ', '.join(os.path.basename(target) for target in targets)
+        elif args.page_mode == 'pages':
+            targets = [os.path.join(os.path.dirname(f), f'{fstem}_{index}{ext}') for index in range(board.page_count(chart))]
+            ftarget = ', '.join(os.path.basename(target) for target in targets)
+        else:
+            targets = [os.path.join(os.path.dirname(f), ftarget)]
+
+        if cache is not None:
+            key = cache.key(chart, board, args.page_mode, tuple(args.scales or ()), profile)
+            if cache.load(key, targets):
+                return True, f'Overview copied from cache to "{ftarget}".'
+
+        encode_time, encode_size = 0.0, 0
+        def save(img, target):
+            nonlocal encode_time, encode_size
+            elapsed, size = encode.save(img, target, profile)
+            encode_time += elapsed
+            encode_size += size
+
+        if args.scales:
+            for target, img in zip(targets, board.generate(chart, workers=args.workers, scales=args.scales)):
+                save(img, target)
+        elif args.page_mode == 'pages':
+            for target, img in zip(targets, board.generate_pages(chart, workers=args.workers)):
+                save(img, target)
+        elif profile == 'svg':
+            write_svg(targets[0], board, chart)
+            encode_size = os.path.getsize(targets[0])
+        elif args.page_mode == 'stream':
+            write_pages(targets[0], board.generate_pages(chart, workers=args.workers), board.page_count(chart), compress_level=_Stream_compress_level[profile])
+            encode_size = os.path.getsize(targets[0])
+        else:
+            img = board.generate(chart, workers=args.workers)
+            save(img, targets[0])
+        if cache is not None:
+            cache.store(key, targets)
+        if profile == 'svg' or (args.page_mode == 'stream' and not args.scales):
+            return True, f'Overview saved to "{ftarget}" ({profile}, {_format_size(encode_size)}).'
+        return True, f'Overview saved to "{ftarget}" ({profile}, {_format_size(encode_size)}, encoded in {encode_time:.2f}s).'
+    except Exception as e:
+        return False, f'Parsing "{f}" failed: {e}.'
+
+def _file_state(f):
+    try:
+        st = os.stat(f)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def watch(patterns, args, interval=0.05, debounce=0.1):
+    # Boards are kept per chart so page templates, sprites and rendered pages
+    # survive between saves and only the pages touched by an edit are redrawn.
+    boards = {}
+    states = {}
+    pending = {}
+    # Favour latency over file size while editing.
+    profile = args.profile or 'fast'
+
+    def update(f):
+        start_time = time.perf_counter()
+        try:
+            chart = read_file(f, args)
+            board = boards.get(f, None)
+            if board is None:
+                board = boards[f] = make_board(args)
+            fstem = _output_stem(f)
+            ext = encode.extension(profile)
+            if args.backend == 'svg':
+                write_svg(os.path.join(os.path.dirname(f), fstem + '.svg'), board, chart)
+                board.dirty_pages = list(range(board.page_count(chart)))
+            elif args.page_mode == 'pages':
+                pages = board.update_pages(chart, workers=args.workers)
+                for index in board.dirty_pages:
+                    encode.save(pages[index], os.path.join(os.path.dirname(f), f'{fstem}_{index}{ext}'), profile)
+            else:
+                encode.save(board.generate_incremental(chart, workers=args.workers), os.path.join(os.path.dirname(f), fstem + ext), profile)
+        except Exception as e:
+            print(f'Parsing "{f}" failed: {e}.', file=sys.stderr)
+            return
+        elapsed = (time.perf_counter() - start_time) * 1000
+        print(f'Updated "{f}" in {elapsed:.0f} ms, {len(board.dirty_pages)} of {board.page_count(chart)} pages redrawn.', file=sys.stderr)
+
+    for f in collect_files(patterns):
+        states[f] = _file_state(f)
+        update(f)
+    print(f'Watching {", ".join(patterns)}.', file=sys.stderr)
+
+    try:
+        while True:
+            now = time.perf_counter()
+            files = collect_files(patterns)
+            for f in files:
+                state = _file_state(f)
+                if state != states.get(f, None):
+                    states[f] = state
+                    # Editors often write a file in several steps; wait until it settles.
+                    pending[f] = now
+            for f in set(states) - set(files):
+                del states[f]
+                boards.pop(f, None)
+                pending.pop(f, None)
+            for f in sorted(f for f, t in pending.items() if now - t >= debounce):
+                del pending[f]
+                update(f)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
 if __name__ == '__main__':
     import argparse
-    import json
-    import os, sys
 
     parser = argparse.ArgumentParser(add_help=False)
 
@@ -18,32 +212,60 @@ if __name__ == '__main__':
     parser.add_argument('--bar-span', '-b', type=int, default=2)
     parser.add_argument('--semi-bar-span', '-B', type=float, default=1/16)
     parser.add_argument('--encoding', '-E', type=str, default='utf8')
+    parser.add_argument('--backend', type=str, choices=_Output_backends, default='pil')
+    parser.add_argument('--page-mode', '-P', type=str, choices=('board', 'pages', 'stream'), default=None)
+    parser.add_argument('--workers', '-w', type=int, default=1)
+    parser.add_argument('--scales', metavar='SCALE', type=float, nargs='+', default=None)
+    parser.add_argument('--profile', '-p', type=str, choices=tuple(encode.PROFILES), default=None)
+    parser.add_argument('--video', type=str, choices=ScrollRenderer.FORMATS, default=None)
+    parser.add_argument('--audio', type=str, default=None)
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--jobs', '-j', type=int, default=1)
+    parser.add_argument('--no-cache', action='store_true', default=False)
+    parser.add_argument('--cache-dir', type=str, default=None)
+    parser.add_argument('--cache-size', type=int, default=RenderCache.DEFAULT_MAX_SIZE >> 20, help='Cache size limit in MB.')
+    parser.add_argument('--watch', '-W', metavar='DIR', type=str, default=None)
     parser.add_argument('--verbose', '-v', action='store_true', default=False)
 
     args = parser.parse_args()
+    if args.page_mode is None:
+        # In watch mode only the pages an edit touched are encoded again; a whole
+        # board would be stitched and encoded on every save.
+        args.page_mode = 'pages' if args.watch is not None and args.backend != 'svg' else 'board'
 
-    for f in args.files:
-        if not os.path.isfile(f):
-            if args.verbose:
-                print(f'File "{f}" is not found.', file=sys.stderr)
-            continue
-        try:
-            if args.verbose:
-                print(f'Parsing "{f}".', file=sys.stderr)
-            fname = os.path.basename(f)
-            if (pt := fname.rfind('.')) != -1:
-                ftarget = fname[:pt] + '.png'
-            else:
-                ftarget = fname + '.png'
-            with open(f, 'r', encoding=args.encoding) as F:
-                chart = F.read()
+    if args.watch is not None:
+        watch([args.watch, *args.files], args)
+        sys.exit(0)
 
-            chart = read(chart)
+    files = collect_files(args.files)
+    cache = None if args.no_cache else RenderCache(args.cache_dir, args.cache_size << 20)
+    start_time = time.perf_counter()
+    if args.jobs > 1 and len(files) > 1:
+        pool = ProcessPoolExecutor(args.jobs)
+        results = pool.map(render_file, files, [args] * len(files), [cache] * len(files))
+    else:
+        pool = None
+        results = (render_file(f, args, cache) for f in files)
 
-            board = Board(scale=args.scale, time_limit=args.page_limit, speed=args.speed, bar_span=args.bar_span, semi_bar_span=args.semi_bar_span)
-            img = board.generate(chart)
-            img.save(os.path.join(os.path.dirname(f), ftarget))
+    failed = []
+    for f, (ok, message) in zip(files, results):
+        if ok:
             if args.verbose:
-                print(f'Overview saved to "{ftarget}".', file=sys.stderr)
-        except Exception as e:
-            print(f'Parsing "{f}" failed: {e}.', file=sys.stderr)
+                print(f'Parsing "{f}".', file=sys.stderr)
+                print(message, file=sys.stderr)
+        else:
+            failed.append(f)
+            if args.verbose or os.path.isfile(f):
+                print(message, file=sys.stderr)
+    if pool is not None:
+        pool.shutdown()
+
+    elapsed = time.perf_counter() - start_time
+    done = len(files) - len(failed)
+    if len(files) > 1 or args.verbose:
+        rate = done / elapsed if elapsed > 0 else 0.0
+        print(f'Rendered {done}/{len(files)} charts in {elapsed:.2f}s ({rate:.2f} charts/s), {len(failed)} failed.', file=sys.stderr)
+        for f in failed:
+            print(f'  {f}', file=sys.stderr)
+    if failed:
+        sys.exit(1)